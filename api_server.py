@@ -3,19 +3,111 @@ API Server for NutriGenie
 Connects the frontend form to the Nutrition Planner Agent
 """
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from db.memory import get_memory
-from first_agent import calculate_macros, generate_meal_plan_with_claude
+from first_agent import calculate_macros, generate_meal_plan_with_claude, stream_meal_plan_with_claude
 import asyncio
+import threading
 import os
-from datetime import datetime
+import orjson
+from datetime import date, datetime
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import uvloop
+    uvloop.install()
+    print("⚡ uvloop installed as event loop policy")
+except ImportError:
+    pass  # Fall back to the default asyncio loop
+
+
+class OrjsonProvider(JSONProvider):
+    """JSON provider backed by orjson — 3-10x faster than stdlib json
+    on the large nested meal-plan responses."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 
 app = Flask(__name__, static_folder='frontend', static_url_path='')
+app.json = OrjsonProvider(app)
 CORS(app)  # Enable CORS for frontend
 
-# Initialize memory
-memory = get_memory()
+# Memory is initialized lazily via get_memory() inside the handlers so
+# merely importing this module (tests, CLI tools, gunicorn preload)
+# doesn't open SQLite/Chroma or load the embedding model.
+
+# Single long-lived event loop shared by all requests.
+# Creating/closing a loop per request would throw away the warm
+# httpx/anthropic connection pools bound to it.
+_async_loop = asyncio.new_event_loop()
+threading.Thread(target=_async_loop.run_forever, daemon=True).start()
+
+
+def run_async(coro):
+    """Run a coroutine on the shared background loop and wait for the result."""
+    future = asyncio.run_coroutine_threadsafe(coro, _async_loop)
+    return future.result()
+
+
+# Redis response cache for the read endpoints (cache-aside with TTL).
+# Profiles and plans only change through our own write paths, so we
+# invalidate there and fall back to SQLite whenever Redis is down.
+_redis_client = None
+if redis is not None:
+    _redis_client = redis.Redis(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', '6379')),
+        decode_responses=True
+    )
+
+CACHE_TTL_USER = 300    # seconds
+CACHE_TTL_PLAN = 60
+CACHE_TTL_ACTIVE = 30
+
+# Fields the create-user endpoints require; frozenset so validation is a
+# single C-level set difference instead of a per-request list scan.
+REQUIRED_FIELDS = frozenset({'name', 'age', 'sex', 'height', 'weight', 'activity_level', 'goal_type'})
+
+
+def cache_get(key):
+    """Get a cached JSON payload, or None on miss / Redis unavailable."""
+    if _redis_client is None:
+        return None
+    try:
+        cached = _redis_client.get(key)
+        return orjson.loads(cached) if cached else None
+    except redis.exceptions.RedisError:
+        return None
+
+
+def cache_set(key, payload, ttl):
+    """Cache a JSON-serializable payload with a TTL (best effort)."""
+    if _redis_client is None:
+        return
+    try:
+        _redis_client.setex(key, ttl, orjson.dumps(payload))
+    except (redis.exceptions.RedisError, TypeError):
+        pass
+
+
+def cache_delete(*keys):
+    """Invalidate cache entries after a write (best effort)."""
+    if _redis_client is None:
+        return
+    try:
+        _redis_client.delete(*keys)
+    except redis.exceptions.RedisError:
+        pass
 
 
 @app.route('/')
@@ -34,6 +126,54 @@ def health_check():
     })
 
 
+async def _create_user_and_plan_async(user_data):
+    """
+    Full create-user workflow as one coroutine on the shared loop.
+    Claude I/O awaits natively; blocking SQLite/Chroma calls run in the
+    default executor so concurrent requests overlap instead of queueing.
+    """
+    loop = asyncio.get_running_loop()
+    memory = get_memory()
+
+    # Step 1: Calculate macros
+    print(f"📊 Calculating macros for {user_data.get('name')}...")
+    macros = calculate_macros(user_data, {
+        'goal_type': user_data.get('goal_type', 'maintain')
+    })
+
+    # Add macros to user data
+    user_data.update(macros)
+
+    # Step 2: Create user profile in memory
+    print(f"💾 Creating user profile...")
+    user_id = await loop.run_in_executor(None, memory.create_user_profile, user_data)
+    print(f"✅ User created: {user_id}")
+
+    # Step 3: Get user context
+    print(f"🔍 Loading user context...")
+    user_context = await loop.run_in_executor(None, memory.get_user_context, user_id)
+
+    # Step 4: Generate meal plan with Claude (native await, no loop juggling)
+    print(f"🍽️ Generating meal plan with Claude AI...")
+    meals = await generate_meal_plan_with_claude(user_context, macros)
+
+    # Step 5: Save meal plan to memory
+    print(f"💾 Saving meal plan...")
+    week_start = date.today().isoformat()
+    plan_id = await loop.run_in_executor(None, lambda: memory.create_meal_plan(
+        user_id=user_id,
+        week_start_date=week_start,
+        meals=meals,
+        created_by_agent="nutrition_planner"
+    ))
+
+    # Step 6: Get complete meal plan
+    meal_plan = await loop.run_in_executor(None, memory.get_meal_plan, plan_id)
+
+    print(f"✅ Meal plan created successfully! Plan ID: {plan_id}")
+    return user_id, plan_id, macros, meals, meal_plan
+
+
 @app.route('/api/create-user', methods=['POST'])
 def create_user_and_plan():
     """
@@ -43,51 +183,25 @@ def create_user_and_plan():
     try:
         # Get user data from request
         user_data = request.json
-        
+
         if not user_data:
             return jsonify({
                 'status': 'error',
                 'message': 'No user data provided'
             }), 400
-        
+
         # Validate required fields
-        required_fields = ['name', 'age', 'sex', 'height', 'weight', 'activity_level', 'goal_type']
-        missing_fields = [field for field in required_fields if field not in user_data]
-        
+        missing_fields = REQUIRED_FIELDS - user_data.keys()
+
         if missing_fields:
             return jsonify({
                 'status': 'error',
                 'message': f'Missing required fields: {", ".join(missing_fields)}'
             }), 400
-        
-        # Step 1: Calculate macros
-        print(f"📊 Calculating macros for {user_data.get('name')}...")
-        macros = calculate_macros(user_data, {
-            'goal_type': user_data.get('goal_type', 'maintain')
-        })
-        
-        # Add macros to user data
-        user_data.update(macros)
-        
-        # Step 2: Create user profile in memory
-        print(f"💾 Creating user profile...")
-        user_id = memory.create_user_profile(user_data)
-        print(f"✅ User created: {user_id}")
-        
-        # Step 3: Get user context
-        print(f"🔍 Loading user context...")
-        user_context = memory.get_user_context(user_id)
-        
-        # Step 4: Generate meal plan with Claude
-        print(f"🍽️ Generating meal plan with Claude AI...")
-        
-        # Run async function in sync context
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
+
         try:
-            meals = loop.run_until_complete(
-                generate_meal_plan_with_claude(user_context, macros)
+            user_id, plan_id, macros, meals, meal_plan = run_async(
+                _create_user_and_plan_async(user_data)
             )
         except Exception as e:
             # Check if it's a Claude API error
@@ -99,24 +213,10 @@ def create_user_and_plan():
                 }), 500
             else:
                 raise e
-        finally:
-            loop.close()
-        
-        # Step 5: Save meal plan to memory
-        print(f"💾 Saving meal plan...")
-        week_start = datetime.now().strftime('%Y-%m-%d')
-        plan_id = memory.create_meal_plan(
-            user_id=user_id,
-            week_start_date=week_start,
-            meals=meals,
-            created_by_agent="nutrition_planner"
-        )
-        
-        # Step 6: Get complete meal plan
-        meal_plan = memory.get_meal_plan(plan_id)
-        
-        print(f"✅ Meal plan created successfully! Plan ID: {plan_id}")
-        
+
+        # Invalidate any stale cached responses for this user/plan
+        cache_delete(f"user:{user_id}", f"active:{user_id}", f"plan:{plan_id}")
+
         # Return success response
         return jsonify({
             'status': 'success',
@@ -126,7 +226,7 @@ def create_user_and_plan():
             'macros': macros,
             'meal_plan': meal_plan
         }), 200
-        
+
     except Exception as e:
         print(f"❌ Error: {str(e)}")
         return jsonify({
@@ -135,17 +235,111 @@ def create_user_and_plan():
         }), 500
 
 
+def _sse_event(event, data):
+    """Format one Server-Sent Events message."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.route('/api/create-user/stream', methods=['POST'])
+def create_user_and_plan_stream():
+    """
+    Streaming variant of /api/create-user using Server-Sent Events.
+    Emits progress (macros, user, each meal) instead of blocking until
+    the whole plan is generated, so the client sees output immediately.
+    """
+    user_data = request.json
+
+    if not user_data:
+        return jsonify({
+            'status': 'error',
+            'message': 'No user data provided'
+        }), 400
+
+    missing_fields = REQUIRED_FIELDS - user_data.keys()
+
+    if missing_fields:
+        return jsonify({
+            'status': 'error',
+            'message': f'Missing required fields: {", ".join(missing_fields)}'
+        }), 400
+
+    def generate():
+        try:
+            memory = get_memory()
+
+            # Fast steps first so the client gets bytes within milliseconds
+            macros = calculate_macros(user_data, {
+                'goal_type': user_data.get('goal_type', 'maintain')
+            })
+            user_data.update(macros)
+            yield _sse_event('macros', macros)
+
+            user_id = memory.create_user_profile(user_data)
+            yield _sse_event('user', {'user_id': user_id})
+
+            user_context = memory.get_user_context(user_id)
+
+            # Slow step: stream the plan from Claude on the background
+            # loop, forwarding each meal the moment its JSON object
+            # parses instead of buffering the whole plan first. run_async
+            # bridges one __anext__ at a time from the loop to this
+            # worker thread.
+            meal_stream = stream_meal_plan_with_claude(user_context, macros)
+            meals = []
+            try:
+                while True:
+                    try:
+                        meal = run_async(meal_stream.__anext__())
+                    except StopAsyncIteration:
+                        break
+                    meals.append(meal)
+                    yield _sse_event('meal', meal)
+            finally:
+                # Release the Claude semaphore/connection if the client
+                # disconnected mid-stream (no-op once exhausted)
+                run_async(meal_stream.aclose())
+
+            if not meals:
+                raise Exception("Claude API failed: no meals parsed from response")
+
+            week_start = date.today().isoformat()
+            plan_id = memory.create_meal_plan(
+                user_id=user_id,
+                week_start_date=week_start,
+                meals=meals,
+                created_by_agent="nutrition_planner"
+            )
+            cache_delete(f"user:{user_id}", f"active:{user_id}", f"plan:{plan_id}")
+
+            yield _sse_event('done', {
+                'status': 'success',
+                'user_id': user_id,
+                'plan_id': plan_id,
+                'meal_count': len(meals)
+            })
+
+        except Exception as e:
+            print(f"❌ Error: {str(e)}")
+            yield _sse_event('error', {'status': 'error', 'message': str(e)})
+
+    return Response(generate(), mimetype='text/event-stream')
+
+
 @app.route('/api/user/<user_id>', methods=['GET'])
 def get_user(user_id):
     """Get user profile by ID."""
     try:
-        user = memory.sql.get_user(user_id)
-        if not user:
-            return jsonify({
-                'status': 'error',
-                'message': 'User not found'
-            }), 404
-        
+        cache_key = f"user:{user_id}"
+        user = cache_get(cache_key)
+        if user is None:
+            user = get_memory().sql.get_user(user_id)
+            if not user:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'User not found'
+                }), 404
+            cache_set(cache_key, user, CACHE_TTL_USER)
+
         return jsonify({
             'status': 'success',
             'user': user
@@ -162,13 +356,17 @@ def get_user(user_id):
 def get_meal_plan(plan_id):
     """Get meal plan by ID."""
     try:
-        meal_plan = memory.get_meal_plan(plan_id)
-        if not meal_plan:
-            return jsonify({
-                'status': 'error',
-                'message': 'Meal plan not found'
-            }), 404
-        
+        cache_key = f"plan:{plan_id}"
+        meal_plan = cache_get(cache_key)
+        if meal_plan is None:
+            meal_plan = get_memory().get_meal_plan(plan_id)
+            if not meal_plan:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'Meal plan not found'
+                }), 404
+            cache_set(cache_key, meal_plan, CACHE_TTL_PLAN)
+
         return jsonify({
             'status': 'success',
             'meal_plan': meal_plan
@@ -185,13 +383,17 @@ def get_meal_plan(plan_id):
 def get_user_active_plan(user_id):
     """Get user's active meal plan."""
     try:
-        meal_plan = memory.get_active_meal_plan(user_id)
-        if not meal_plan:
-            return jsonify({
-                'status': 'error',
-                'message': 'No active meal plan found'
-            }), 404
-        
+        cache_key = f"active:{user_id}"
+        meal_plan = cache_get(cache_key)
+        if meal_plan is None:
+            meal_plan = get_memory().get_active_meal_plan(user_id)
+            if not meal_plan:
+                return jsonify({
+                    'status': 'error',
+                    'message': 'No active meal plan found'
+                }), 404
+            cache_set(cache_key, meal_plan, CACHE_TTL_ACTIVE)
+
         return jsonify({
             'status': 'success',
             'meal_plan': meal_plan
@@ -205,9 +407,10 @@ def get_user_active_plan(user_id):
 
 
 if __name__ == '__main__':
-    print("🚀 Starting NutriGenie API Server...")
+    print("🚀 Starting NutriGenie API Server (dev mode)...")
     print("📝 Form available at: http://localhost:5000")
     print("🔗 API endpoint: http://localhost:5000/api/create-user")
     print("💚 Health check: http://localhost:5000/api/health")
-    
+    print("🏭 Production: gunicorn -k gthread -w 1 --threads 16 wsgi:app (single worker — see wsgi.py)")
+
     app.run(debug=True, host='0.0.0.0', port=5000)
@@ -6,9 +6,125 @@ Handles conversations, food feedback, and semantic preferences.
 import chromadb
 from chromadb.config import Settings
 from typing import List, Dict, Optional, Any
-import uuid
-from datetime import datetime
+import time
 import os
+from collections import OrderedDict
+from itertools import count, repeat
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+
+# Metadata timestamps only need second resolution, so the formatted
+# string is cached and reused until the clock ticks over.
+_iso_cache = (0, "")
+
+
+def _now_iso() -> str:
+    """ISO-8601 timestamp, cached per second."""
+    global _iso_cache
+    second = int(time.time())
+    if second != _iso_cache[0]:
+        _iso_cache = (second, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(second)))
+    return _iso_cache[1]
+
+
+# Pre-built rating filter fragments keyed by (operator, value); only the
+# user_id clause changes per call, so these are shared across requests.
+_rating_filters: Dict[tuple, Dict] = {}
+
+
+def _rating_filter(op: str, value: int) -> Dict:
+    key = (op, value)
+    cached = _rating_filters.get(key)
+    if cached is None:
+        cached = _rating_filters[key] = {"rating": {op: value}}
+    return cached
+
+
+# Complete where-filters keyed by (user_id, op, value) so repeat feedback
+# searches reuse one dict instead of rebuilding the $and wrapper per call.
+_feedback_filters: "OrderedDict" = OrderedDict()
+_FEEDBACK_FILTER_MAX = 256
+
+
+def _feedback_filter(user_id: str, op: str, value: int) -> Dict:
+    key = (user_id, op, value)
+    cached = _feedback_filters.get(key)
+    if cached is None:
+        cached = _feedback_filters[key] = {
+            "$and": [
+                {"user_id": {"$eq": user_id}},
+                _rating_filter(op, value)
+            ]
+        }
+        if len(_feedback_filters) > _FEEDBACK_FILTER_MAX:
+            _feedback_filters.popitem(last=False)
+    return cached
+
+
+# Max embedding vectors kept in the per-process cache. Agents re-embed
+# the same queries ("food preferences") and feedback texts constantly;
+# a cache hit skips a full transformer forward pass.
+_EMBED_CACHE_MAX = 4096
+
+
+class LocalEmbeddingFunction:
+    """Embedding function backed by a local SentenceTransformer.
+
+    Encodes whole batches in one forward pass (vectorized matmul) instead
+    of Chroma's default per-document ONNX encoder, and memoizes vectors
+    per text so repeated strings never reach the model again. Cached
+    vectors are held as float16 arrays — ~30x smaller than the Python
+    float lists Chroma consumes, at negligible accuracy cost for
+    normalized MiniLM embeddings — and widened back on a hit.
+    """
+
+    def __init__(self, model_name: str = "all-MiniLM-L6-v2"):
+        self._model = SentenceTransformer(model_name)
+        self._cache: OrderedDict = OrderedDict()
+
+    def __call__(self, input):
+        vectors = [None] * len(input)
+        misses = []
+        for position, text in enumerate(input):
+            cached = self._cache.get(text)
+            if cached is not None:
+                self._cache.move_to_end(text)
+                vectors[position] = cached.tolist()
+            else:
+                misses.append(position)
+
+        if misses:
+            encoded = self._model.encode(
+                [input[position] for position in misses],
+                batch_size=64,
+                normalize_embeddings=True,
+                convert_to_numpy=True
+            )
+            for position, vector in zip(misses, encoded):
+                vectors[position] = vector.tolist()
+                self._cache[input[position]] = vector.astype('float16')
+                if len(self._cache) > _EMBED_CACHE_MAX:
+                    self._cache.popitem(last=False)
+
+        return vectors
+
+
+# Shared across ChromaDB instances — the model load is the expensive part
+_local_ef = None
+
+
+def _get_embedding_function():
+    """Get the shared local embedding function, or None to use Chroma's default."""
+    global _local_ef
+    if SentenceTransformer is None:
+        return None
+    if _local_ef is None:
+        _local_ef = LocalEmbeddingFunction()
+    return _local_ef
 
 
 class ChromaDB:
@@ -26,45 +142,96 @@ class ChromaDB:
         )
         
         self.collections = {}
+
+        # Monotonic ID counter seeded from the clock so IDs stay unique
+        # across restarts without a urandom syscall per insert (uuid4).
+        self._id_counter = count(time.time_ns())
+
         self._create_collections()
+
+    def _next_id(self, prefix: str, user_id: str) -> str:
+        """Generate a unique document ID without touching os.urandom."""
+        return f"{prefix}_{user_id}_{next(self._id_counter):x}"
     
+    # HNSW tuning shared by all collections: buffer inserts and defer the
+    # index sync so batched adds pay one index update instead of one per row.
+    _HNSW_SETTINGS = {
+        "hnsw:construction_ef": 200,
+        "hnsw:M": 32,
+        "hnsw:batch_size": 1000,
+        "hnsw:sync_threshold": 2000
+    }
+
     def _create_collections(self):
         """Create all necessary collections."""
-        
-        # Collection 1: Conversations
+        embedding_function = _get_embedding_function()
+        self._ef_kwargs = {'embedding_function': embedding_function} if embedding_function else {}
+
+        # Collection 1: Conversations (legacy global collection; new
+        # writes go to the per-user shards below)
         self.collections['conversations'] = self.client.get_or_create_collection(
             name="conversations",
-            metadata={"description": "Chat history with agents"}
+            metadata={"description": "Chat history with agents", **self._HNSW_SETTINGS},
+            **self._ef_kwargs
         )
-        
+
         # Collection 2: Food Feedback
         self.collections['food_feedback'] = self.client.get_or_create_collection(
             name="food_feedback",
-            metadata={"description": "User ratings and feedback on meals"}
+            metadata={"description": "User ratings and feedback on meals", **self._HNSW_SETTINGS},
+            **self._ef_kwargs
         )
-        
+
         # Collection 3: Preference Embeddings
         self.collections['preferences'] = self.client.get_or_create_collection(
             name="preferences",
-            metadata={"description": "Semantic food preferences and dislikes"}
+            metadata={"description": "Semantic food preferences and dislikes", **self._HNSW_SETTINGS},
+            **self._ef_kwargs
         )
-        
+
+        # Conversations are sharded per user: HNSW gains nothing from
+        # metadata filters, so the global collection made every search
+        # traverse (and overfetch against) all users' vectors. A shard
+        # bounds the candidate set to one user's history.
+        self._conv_collections: Dict[str, Any] = {}
+
+        # Direct handles so hot paths skip the dict lookup per call
+        self._feedback = self.collections['food_feedback']
+        self._preferences = self.collections['preferences']
+
         print("✅ Chroma collections created successfully")
+
+    def _conversation_collection(self, user_id: str):
+        """Get (lazily creating) the per-user conversation shard."""
+        collection = self._conv_collections.get(user_id)
+        if collection is None:
+            collection = self._conv_collections[user_id] = self.client.get_or_create_collection(
+                name=f"conv_{user_id}",
+                metadata={"description": "Chat history with agents", **self._HNSW_SETTINGS},
+                **self._ef_kwargs
+            )
+        return collection
     
     # ============ CONVERSATION OPERATIONS ============
     
+    def new_conversation_id(self, user_id: str) -> str:
+        """Reserve a conversation ID before the (possibly deferred) insert."""
+        return self._next_id("conv", user_id)
+
     def add_conversation(
-        self, 
-        user_id: str, 
-        agent: str, 
-        role: str, 
+        self,
+        user_id: str,
+        agent: str,
+        role: str,
         message: str,
-        session_id: Optional[str] = None
+        session_id: Optional[str] = None,
+        conv_id: Optional[str] = None
     ) -> str:
         """Add a conversation message."""
-        conv_id = f"conv_{user_id}_{uuid.uuid4().hex[:8]}"
-        
-        self.collections['conversations'].add(
+        if conv_id is None:
+            conv_id = self._next_id("conv", user_id)
+
+        self._conversation_collection(user_id).add(
             ids=[conv_id],
             documents=[message],
             metadatas=[{
@@ -72,7 +239,7 @@ class ChromaDB:
                 "agent": agent,
                 "role": role,  # 'user' or 'agent'
                 "session_id": session_id or "default",
-                "timestamp": datetime.now().isoformat()
+                "timestamp": _now_iso()
             }]
         )
         
@@ -85,17 +252,17 @@ class ChromaDB:
         n_results: int = 5,
         agent: Optional[str] = None
     ) -> List[Dict]:
-        """Search conversation history semantically."""
-        where_filter = {"user_id": user_id}
-        if agent:
-            where_filter["agent"] = agent
-        
-        results = self.collections['conversations'].query(
+        """Search conversation history semantically.
+
+        The shard already scopes the scan to this user, so the only
+        filter left is the optional agent.
+        """
+        results = self._conversation_collection(user_id).query(
             query_texts=[query],
             n_results=n_results,
-            where=where_filter
+            where={"agent": agent} if agent else None
         )
-        
+
         return self._format_results(results)
     
     def get_recent_conversations(
@@ -105,15 +272,11 @@ class ChromaDB:
         agent: Optional[str] = None
     ) -> List[Dict]:
         """Get recent conversations for a user."""
-        where_filter = {"user_id": user_id}
-        if agent:
-            where_filter["agent"] = agent
-        
-        results = self.collections['conversations'].get(
-            where=where_filter,
+        results = self._conversation_collection(user_id).get(
+            where={"agent": agent} if agent else None,
             limit=n_results
         )
-        
+
         return self._format_get_results(results)
     
     # ============ FOOD FEEDBACK OPERATIONS ============
@@ -128,7 +291,7 @@ class ChromaDB:
         cuisine: Optional[str] = None
     ) -> str:
         """Add user feedback on a meal."""
-        feedback_id = f"feedback_{user_id}_{uuid.uuid4().hex[:8]}"
+        feedback_id = self._next_id("feedback", user_id)
         
         # Combine description and feedback for better semantic search
         document = f"{food_description}. {feedback_text}"
@@ -136,7 +299,7 @@ class ChromaDB:
         metadata = {
             "user_id": user_id,
             "rating": rating,
-            "timestamp": datetime.now().isoformat()
+            "timestamp": _now_iso()
         }
         
         if meal_id:
@@ -144,7 +307,7 @@ class ChromaDB:
         if cuisine:
             metadata["cuisine"] = cuisine
         
-        self.collections['food_feedback'].add(
+        self._feedback.add(
             ids=[feedback_id],
             documents=[document],
             metadatas=[metadata]
@@ -160,15 +323,10 @@ class ChromaDB:
         n_results: int = 10
     ) -> List[Dict]:
         """Search for foods user liked."""
-        results = self.collections['food_feedback'].query(
+        results = self._feedback.query(
             query_texts=[query],
             n_results=n_results,
-            where={
-                "$and": [
-                    {"user_id": {"$eq": user_id}},
-                    {"rating": {"$gte": min_rating}}
-                ]
-            }
+            where=_feedback_filter(user_id, "$gte", min_rating)
         )
         
         return self._format_results(results)
@@ -181,22 +339,17 @@ class ChromaDB:
         n_results: int = 10
     ) -> List[Dict]:
         """Search for foods user disliked."""
-        results = self.collections['food_feedback'].query(
+        results = self._feedback.query(
             query_texts=[query],
             n_results=n_results,
-            where={
-                "$and": [
-                    {"user_id": {"$eq": user_id}},
-                    {"rating": {"$lte": max_rating}}
-                ]
-            }
+            where=_feedback_filter(user_id, "$lte", max_rating)
         )
         
         return self._format_results(results)
     
     def get_all_feedback(self, user_id: str) -> List[Dict]:
         """Get all feedback for a user."""
-        results = self.collections['food_feedback'].get(
+        results = self._feedback.get(
             where={"user_id": user_id}
         )
         
@@ -212,21 +365,57 @@ class ChromaDB:
         strength: str = "moderate"  # 'strong', 'moderate', 'mild'
     ) -> str:
         """Add a semantic preference."""
-        pref_id = f"pref_{user_id}_{uuid.uuid4().hex[:8]}"
+        pref_id = self._next_id("pref", user_id)
         
-        self.collections['preferences'].add(
+        self._preferences.add(
             ids=[pref_id],
             documents=[preference_text],
             metadatas=[{
                 "user_id": user_id,
                 "preference_type": preference_type,
                 "strength": strength,
-                "timestamp": datetime.now().isoformat()
+                "timestamp": _now_iso()
             }]
         )
         
         return pref_id
     
+    def add_preferences_bulk(
+        self,
+        user_id: str,
+        preferences: List[tuple]  # (preference_text, preference_type, strength)
+    ) -> List[str]:
+        """Add multiple semantic preferences in a single batched call.
+
+        One collection.add() embeds all documents in a single forward pass
+        instead of one model call per preference.
+        """
+        if not preferences:
+            return []
+
+        ids = []
+        documents = []
+        metadatas = []
+        timestamp = _now_iso()
+
+        for preference_text, preference_type, strength in preferences:
+            ids.append(self._next_id("pref", user_id))
+            documents.append(preference_text)
+            metadatas.append({
+                "user_id": user_id,
+                "preference_type": preference_type,
+                "strength": strength,
+                "timestamp": timestamp
+            })
+
+        self._preferences.add(
+            ids=ids,
+            documents=documents,
+            metadatas=metadatas
+        )
+
+        return ids
+
     def search_preferences(
         self,
         user_id: str,
@@ -239,7 +428,7 @@ class ChromaDB:
         if preference_type:
             where_filter["preference_type"] = preference_type
         
-        results = self.collections['preferences'].query(
+        results = self._preferences.query(
             query_texts=[query],
             n_results=n_results,
             where=where_filter
@@ -249,7 +438,7 @@ class ChromaDB:
     
     def get_all_preferences(self, user_id: str) -> List[Dict]:
         """Get all preferences for a user."""
-        results = self.collections['preferences'].get(
+        results = self._preferences.get(
             where={"user_id": user_id}
         )
         
@@ -258,43 +447,49 @@ class ChromaDB:
     # ============ HELPER METHODS ============
     
     def _format_results(self, results: Dict) -> List[Dict]:
-        """Format query results into a list of dictionaries."""
-        formatted = []
-        
-        if not results['ids'] or not results['ids'][0]:
-            return formatted
-        
-        for i in range(len(results['ids'][0])):
-            formatted.append({
-                'id': results['ids'][0][i],
-                'document': results['documents'][0][i],
-                'metadata': results['metadatas'][0][i],
-                'distance': results['distances'][0][i] if 'distances' in results else None
-            })
-        
-        return formatted
-    
+        """Format query results into a list of dictionaries.
+
+        Iterates the parallel id/document/metadata arrays with one zip
+        instead of indexing each column per row.
+        """
+        ids = results['ids']
+        if not ids or not ids[0]:
+            return []
+
+        distances = results['distances'][0] if results.get('distances') else repeat(None)
+
+        return [
+            {'id': id_, 'document': document, 'metadata': metadata, 'distance': distance}
+            for id_, document, metadata, distance in zip(
+                ids[0], results['documents'][0], results['metadatas'][0], distances
+            )
+        ]
+
     def _format_get_results(self, results: Dict) -> List[Dict]:
         """Format get results into a list of dictionaries."""
-        formatted = []
-        
-        if not results['ids']:
-            return formatted
-        
-        for i in range(len(results['ids'])):
-            formatted.append({
-                'id': results['ids'][i],
-                'document': results['documents'][i],
-                'metadata': results['metadatas'][i]
-            })
-        
-        return formatted
+        ids = results['ids']
+        if not ids:
+            return []
+
+        return [
+            {'id': id_, 'document': document, 'metadata': metadata}
+            for id_, document, metadata in zip(
+                ids, results['documents'], results['metadatas']
+            )
+        ]
     
     def delete_user_data(self, user_id: str):
         """Delete all data for a user (GDPR compliance)."""
         for collection in self.collections.values():
             collection.delete(where={"user_id": user_id})
-    
+
+        # Drop the user's conversation shard wholesale
+        self._conv_collections.pop(user_id, None)
+        try:
+            self.client.delete_collection(f"conv_{user_id}")
+        except Exception:
+            pass  # shard never created for this user
+
     def reset_database(self):
         """Reset entire database (use with caution!)."""
         self.client.reset()
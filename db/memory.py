@@ -5,12 +5,25 @@ Agents should always use this layer instead of directly accessing SQLite or Chro
 
 from typing import Dict, List, Optional, Any
 from .sqlite_db import SQLiteDB
-from .chroma_db import ChromaDB
+from .chroma_db import ChromaDB, _get_embedding_function
+from concurrent.futures import ThreadPoolExecutor
 import os
+import threading
 from dotenv import load_dotenv
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 load_dotenv()
 
+# Semantic query cache: a repeat query whose embedding lands within this
+# cosine similarity of a cached one reuses the cached results outright.
+# Vectors come back normalized, so the dot product is the cosine.
+_SEMANTIC_THRESHOLD = 0.9
+_SEMANTIC_CACHE_MAX = 64  # cached (vector, results) pairs per user
+
 
 class Memory:
     """
@@ -29,8 +42,41 @@ class Memory:
         
         self.sql = SQLiteDB(sqlite_path)
         self.vector = ChromaDB(chroma_path)
-        
+
+        # In-process caches invalidated on writes. The context cache avoids
+        # re-running the 7 SQL/Chroma queries per agent call; the food-prefs
+        # and conversation-search caches avoid the vector searches agents
+        # repeat with the same query between writes.
+        self._context_cache: Dict[str, Dict[str, Any]] = {}
+        self._food_prefs_cache: Dict[str, Dict[str, Any]] = {}
+        self._conv_search_cache: Dict[str, Dict[tuple, List[Dict]]] = {}
+        self._conv_semantic_cache: Dict[str, List[tuple]] = {}
+
+        # Background writer for chat logging: the embed + Chroma insert
+        # (~10-15 ms) runs off the caller's thread. flush() is the read
+        # barrier that joins pending writes before any conversation read.
+        self._write_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='memory-write')
+        self._pending_writes: List = []
+        self._pending_lock = threading.Lock()
+
         print("✅ Memory layer initialized with SQLite + Chroma")
+
+    def flush(self):
+        """Wait for queued background writes so reads see them."""
+        with self._pending_lock:
+            pending, self._pending_writes = self._pending_writes, []
+        for future in pending:
+            try:
+                future.result()
+            except Exception as e:
+                print(f"⚠️ Background memory write failed: {e}")
+
+    def _invalidate_context(self, user_id: str):
+        """Drop cached context and food preferences for a user after any write."""
+        self._context_cache.pop(user_id, None)
+        self._food_prefs_cache.pop(user_id, None)
+        self._conv_search_cache.pop(user_id, None)
+        self._conv_semantic_cache.pop(user_id, None)
     
     # ============ USER PROFILE OPERATIONS ============
     
@@ -39,64 +85,49 @@ class Memory:
         Create complete user profile from form data.
         Stores structured data in SQL and semantic preferences in Chroma.
         """
-        # 1. Create user in SQLite
-        user_id = self.sql.create_user({
-            'name': user_data.get('name'),
-            'email': user_data.get('email'),
-            'age': user_data.get('age'),
-            'sex': user_data.get('sex'),
-            'height': user_data.get('height'),
-            'weight': user_data.get('weight'),
-            'country': user_data.get('country'),
-            'ethnicity': user_data.get('ethnicity'),
-            'activity_level': user_data.get('activity_level')
-        })
-        
-        # 2. Create goals
-        if 'goal_type' in user_data:
-            self.sql.create_goal(user_id, {
-                'goal_type': user_data.get('goal_type'),
-                'target_weight': user_data.get('target_weight'),
-                'target_timeline_weeks': user_data.get('target_timeline_weeks'),
-                'daily_calories': user_data.get('daily_calories'),
-                'protein_g': user_data.get('protein_g'),
-                'carbs_g': user_data.get('carbs_g'),
-                'fats_g': user_data.get('fats_g')
-            })
-        
-        # 3. Add restrictions (allergies, medical, religious)
-        if 'allergies' in user_data and user_data['allergies']:
-            for allergy in user_data['allergies']:
-                self.sql.add_restriction(user_id, 'allergy', allergy, 'critical')
-        
-        if 'medical_conditions' in user_data and user_data['medical_conditions']:
-            for condition in user_data['medical_conditions']:
-                self.sql.add_restriction(user_id, 'medical', condition, 'important')
-        
-        if 'religious_restrictions' in user_data and user_data['religious_restrictions']:
-            for restriction in user_data['religious_restrictions']:
-                self.sql.add_restriction(user_id, 'religious', restriction, 'important')
-        
-        # 4. Create preferences
-        if 'diet_type' in user_data:
-            self.sql.create_preferences(user_id, {
-                'diet_type': user_data.get('diet_type'),
-                'cuisine_preferences': user_data.get('cuisine_preferences', []),
-                'meals_per_day': user_data.get('meals_per_day', 3),
-                'cooking_time_max': user_data.get('cooking_time_max'),
-                'budget_weekly': user_data.get('budget_weekly'),
-                'meal_complexity': user_data.get('meal_complexity', 'moderate')
-            })
-        
-        # 5. Add semantic preferences to Chroma
-        if 'food_likes' in user_data and user_data['food_likes']:
-            for like in user_data['food_likes']:
-                self.vector.add_preference(user_id, like, 'like', 'strong')
-        
-        if 'food_dislikes' in user_data and user_data['food_dislikes']:
-            for dislike in user_data['food_dislikes']:
-                self.vector.add_preference(user_id, dislike, 'dislike', 'strong')
+        # Steps 1-4 are SQL writes; one transaction = one fsync for the
+        # whole onboarding batch instead of one per insert. The form dict
+        # already uses the mutators' key names, so it is passed straight
+        # through instead of being re-shaped into throwaway dicts — each
+        # mutator binds its whitelisted columns to a fixed SQL constant.
+        with self.sql.transaction():
+            # 1. Create user in SQLite
+            user_id = self.sql.create_user(user_data)
+
+            # 2. Create goals
+            if 'goal_type' in user_data:
+                self.sql.create_goal(user_id, user_data)
+
+            # 3. Add restrictions (allergies, medical, religious) in one insert
+            restrictions = [
+                (kind, value, severity)
+                for kind, values, severity in (
+                    ('allergy', user_data.get('allergies'), 'critical'),
+                    ('medical', user_data.get('medical_conditions'), 'important'),
+                    ('religious', user_data.get('religious_restrictions'), 'important')
+                )
+                for value in values or ()
+            ]
+            if restrictions:
+                self.sql.add_restrictions_bulk(user_id, restrictions)
+
+            # 4. Create preferences
+            if 'diet_type' in user_data:
+                self.sql.create_preferences(user_id, user_data)
+
+        # 5. Add semantic preferences to Chroma (single batched embed + write)
+        preferences = [
+            (value, kind, 'strong')
+            for kind, values in (
+                ('like', user_data.get('food_likes')),
+                ('dislike', user_data.get('food_dislikes'))
+            )
+            for value in values or ()
+        ]
+        if preferences:
+            self.vector.add_preferences_bulk(user_id, preferences)
         
+        self._invalidate_context(user_id)
         print(f"✅ Created user profile: {user_id}")
         return user_id
     
@@ -104,17 +135,22 @@ class Memory:
         """
         Get complete user context for agents.
         Combines structured data from SQL and semantic context from Chroma.
+        Cached per user until the next write for that user.
         """
-        context = {
-            'user': self.sql.get_user(user_id),
-            'goals': self.sql.get_active_goals(user_id),
-            'restrictions': self.sql.get_restrictions(user_id),
-            'preferences': self.sql.get_preferences(user_id),
+        cached = self._context_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        self.flush()  # make queued conversation writes visible
+        # One SQL round trip for the four structured pieces instead of four
+        context = self.sql.get_user_bundle(user_id)
+        context.update({
             'semantic_preferences': self.vector.get_all_preferences(user_id),
             'recent_conversations': self.vector.get_recent_conversations(user_id, n_results=5),
             'food_feedback': self.vector.get_all_feedback(user_id)
-        }
-        
+        })
+
+        self._context_cache[user_id] = context
         return context
     
     # ============ CONVERSATION OPERATIONS ============
@@ -127,8 +163,21 @@ class Memory:
         message: str,
         session_id: Optional[str] = None
     ) -> str:
-        """Save a conversation message."""
-        return self.vector.add_conversation(user_id, agent, role, message, session_id)
+        """Save a conversation message.
+
+        Returns the reserved conv_id immediately; the embed + vector
+        insert runs on the background writer so chat logging doesn't
+        block on a transformer forward pass. Reads flush() first.
+        """
+        self._invalidate_context(user_id)
+        conv_id = self.vector.new_conversation_id(user_id)
+        future = self._write_executor.submit(
+            self.vector.add_conversation,
+            user_id, agent, role, message, session_id, conv_id
+        )
+        with self._pending_lock:
+            self._pending_writes.append(future)
+        return conv_id
     
     def search_conversation_context(
         self,
@@ -137,8 +186,50 @@ class Memory:
         agent: Optional[str] = None,
         n_results: int = 5
     ) -> List[Dict]:
-        """Search conversation history for relevant context."""
-        return self.vector.search_conversations(user_id, query, n_results, agent)
+        """Search conversation history for relevant context.
+        Cached per (user, query, agent, n) until the next write for that
+        user — the corpus only changes through our own save paths, so a
+        repeat query can skip the embed + vector search entirely. Near-
+        duplicate queries ("food preferences" / "preferred foods") hit a
+        semantic cache: within cosine >= 0.9 of a cached query, the
+        cached results are reused without touching the vector index.
+        """
+        self.flush()  # make queued conversation writes visible
+        user_cache = self._conv_search_cache.setdefault(user_id, {})
+        key = (query, agent, n_results)
+        cached = user_cache.get(key)
+        if cached is not None:
+            return cached
+
+        query_vec = self._embed_query(query)
+        if query_vec is not None:
+            entries = self._conv_semantic_cache.get(user_id, ())
+            for cached_vec, cached_agent, cached_n, cached_results in entries:
+                if cached_agent != agent or cached_n != n_results:
+                    continue
+                if float(np.dot(cached_vec, query_vec)) >= _SEMANTIC_THRESHOLD:
+                    user_cache[key] = cached_results
+                    return cached_results
+
+        results = self.vector.search_conversations(user_id, query, n_results, agent)
+        user_cache[key] = results
+
+        if query_vec is not None:
+            entries = self._conv_semantic_cache.setdefault(user_id, [])
+            entries.append((query_vec, agent, n_results, results))
+            if len(entries) > _SEMANTIC_CACHE_MAX:
+                entries.pop(0)
+        return results
+
+    @staticmethod
+    def _embed_query(query: str):
+        """Embed a query with the shared local model, or None if unavailable."""
+        if np is None:
+            return None
+        embed = _get_embedding_function()
+        if embed is None:
+            return None
+        return np.asarray(embed([query])[0], dtype=np.float32)
     
     # ============ MEAL PLAN OPERATIONS ============
     
@@ -152,12 +243,11 @@ class Memory:
         """
         Create a complete meal plan with all meals.
         """
-        # Create plan
-        plan_id = self.sql.create_meal_plan(user_id, week_start_date, created_by_agent)
-        
-        # Add all meals
-        for meal in meals:
-            self.sql.add_planned_meal(plan_id, user_id, meal)
+        # Plan row + all meal rows in one transaction: a weekly plan costs
+        # a single fsync instead of one for the plan and one for the meals.
+        with self.sql.transaction():
+            plan_id = self.sql.create_meal_plan(user_id, week_start_date, created_by_agent)
+            self.sql.add_planned_meals(plan_id, user_id, meals)
         
         # Log in conversation history
         self.vector.add_conversation(
@@ -168,9 +258,22 @@ class Memory:
             session_id=plan_id
         )
         
+        self._invalidate_context(user_id)
         print(f"✅ Created meal plan: {plan_id} with {len(meals)} meals")
         return plan_id
     
+    def save_pending_completion(self, user_id: str, content_hash: str, meals: List[Dict[str, Any]]):
+        """Persist a parsed Claude completion before the plan is finalized."""
+        self.sql.save_pending_completion(user_id, content_hash, meals)
+
+    def get_pending_completion(self, user_id: str, content_hash: str) -> Optional[List[Dict[str, Any]]]:
+        """Get a saved completion from a previous failed attempt, if any."""
+        return self.sql.get_pending_completion(user_id, content_hash)
+
+    def delete_pending_completion(self, user_id: str, content_hash: str):
+        """Drop a pending completion once its plan has been created."""
+        self.sql.delete_pending_completion(user_id, content_hash)
+
     def get_active_meal_plan(self, user_id: str) -> Optional[Dict]:
         """Get user's active meal plan."""
         return self.sql.get_user_active_plan(user_id)
@@ -198,7 +301,8 @@ class Memory:
             'user',
             f"Ate: {meal_data.get('food_description')} ({meal_data.get('calories')} cal)"
         )
-        
+
+        self._invalidate_context(user_id)
         return actual_id
     
     def modify_meal_plan(
@@ -219,7 +323,8 @@ class Memory:
             'agent',
             f"Modified meal plan: {modification_data.get('reason')}"
         )
-        
+
+        self._invalidate_context(user_id)
         return mod_id
     
     # ============ FEEDBACK OPERATIONS ============
@@ -234,6 +339,7 @@ class Memory:
         cuisine: Optional[str] = None
     ) -> str:
         """Save user feedback on a meal."""
+        self._invalidate_context(user_id)
         return self.vector.add_food_feedback(
             user_id,
             meal_id,
@@ -248,40 +354,43 @@ class Memory:
         user_id: str,
         query: str = "food preferences"
     ) -> Dict[str, List[Dict]]:
-        """Get semantic food preferences for meal planning."""
-        return {
+        """Get semantic food preferences for meal planning.
+        Cached per (user, query) until the next write for that user.
+        """
+        user_cache = self._food_prefs_cache.setdefault(user_id, {})
+        cached = user_cache.get(query)
+        if cached is not None:
+            return cached
+
+        result = {
             'liked_foods': self.vector.search_liked_foods(user_id, query, min_rating=4),
             'disliked_foods': self.vector.search_disliked_foods(user_id, query, max_rating=2),
             'preferences': self.vector.search_preferences(user_id, query)
         }
+        user_cache[query] = result
+        return result
     
     # ============ AGENT HELPER METHODS ============
     
     def get_safety_restrictions(self, user_id: str) -> List[str]:
         """Get critical restrictions (allergies, medical) for safety checks."""
-        restrictions = self.sql.get_restrictions(user_id)
-        critical = [
-            r['restriction'] 
-            for r in restrictions 
-            if r['severity'] in ['critical', 'important']
-        ]
-        return critical
+        return self.sql.get_critical_restrictions(user_id)
+
+    def get_safety_summary(self, user_id: str) -> str:
+        """Get critical restrictions as one display string (joined in SQL)."""
+        return self.sql.get_critical_restrictions_summary(user_id)
     
     def calculate_daily_macros(self, user_id: str) -> Dict[str, int]:
-        """Get target daily macros for user."""
-        goals = self.sql.get_active_goals(user_id)
-        if goals:
-            goal = goals[0]
-            return {
-                'calories': goal['daily_calories'],
-                'protein_g': goal['protein_g'],
-                'carbs_g': goal['carbs_g'],
-                'fats_g': goal['fats_g']
-            }
-        return {}
+        """Get target daily macros for user (persisted at profile create,
+        fetched verbatim — no per-call recomputation)."""
+        return self.sql.get_daily_macros(user_id)
     
     def clear_all_data(self):
         """Clear all data from both databases (useful for testing)."""
+        self._context_cache.clear()
+        self._food_prefs_cache.clear()
+        self._conv_search_cache.clear()
+        self._conv_semantic_cache.clear()
         self.sql.clear_all_data()
         # Note: Chroma collections can't be easily cleared without recreating
         # For now, we'll just clear SQL data
@@ -293,16 +402,24 @@ class Memory:
 
     def close(self):
         """Close all database connections."""
+        self.flush()
+        self._write_executor.shutdown(wait=True)
         self.sql.close()
         print("✅ Memory layer closed")
 
 
 # Global memory instance (singleton pattern)
 _memory_instance = None
+_memory_lock = threading.Lock()
+
 
 def get_memory() -> Memory:
-    """Get global memory instance."""
+    """Get global memory instance (lazy, thread-safe)."""
     global _memory_instance
     if _memory_instance is None:
-        _memory_instance = Memory()
+        # Double-checked locking: only the first caller pays the init,
+        # concurrent WSGI threads can't race a second Memory into being.
+        with _memory_lock:
+            if _memory_instance is None:
+                _memory_instance = Memory()
     return _memory_instance
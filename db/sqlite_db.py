@@ -4,24 +4,419 @@ Handles users, goals, restrictions, preferences, meal plans, and tracking.
 """
 
 import sqlite3
+import sys
+import threading
 import uuid
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import chain
 from typing import Dict, List, Optional, Any
-import json
+import orjson
 import os
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def _pack_list(items: List) -> Any:
+    """Serialize a list column: msgpack bytes when available, JSON text otherwise.
+
+    msgpack unpacks list-of-strings payloads several times faster than
+    JSON parsing and the BLOB is smaller on disk.
+    """
+    if msgpack is not None:
+        return msgpack.packb(items)
+    # orjson serializes lists but not tuples; callers may pass either
+    return orjson.dumps(list(items)).decode()
+
+
+def _unpack_list(value) -> List:
+    """Deserialize a list column written by any past format.
+
+    Branches on the stored type: msgpack rows come back as bytes,
+    JSON rows (including pre-migration data) as str.
+    """
+    if isinstance(value, bytes) and msgpack is not None:
+        return msgpack.unpackb(value, raw=False)
+    return orjson.loads(value)
+
+
+def _new_id() -> str:
+    """Generate a row ID: uuid4 as 32 hex chars (no dashes).
+
+    4 bytes shorter than str(uuid4()) per key, which shrinks every
+    primary-key and index entry and speeds up the WHERE id = ? memcmp.
+    """
+    return uuid.uuid4().hex
+
+
+# Integer sort keys for planned meals, precomputed at insert time so
+# get_meal_plan can ORDER BY an indexed column instead of evaluating a
+# CASE expression per row.
+_DAY_IDX = {
+    'monday': 0, 'tuesday': 1, 'wednesday': 2, 'thursday': 3,
+    'friday': 4, 'saturday': 5, 'sunday': 6
+}
+_MEAL_IDX = {'breakfast': 0, 'lunch': 1, 'dinner': 2, 'snack': 3}
+
+# Interned copies of the day/meal vocabulary. Binding the same string
+# object for every 'monday' in a batch (instead of 21+ fresh parses of
+# the same text) is the Python-level analogue of SQLITE_STATIC binding.
+_INTERNED_NAMES = {name: sys.intern(name) for name in (*_DAY_IDX, *_MEAL_IDX)}
+
+# Max users held in each per-table read cache before LRU eviction
+_READ_CACHE_MAX = 128
+
+# INSERT ... RETURNING needs SQLite 3.35+ (2021); fall back to a plain
+# insert on older library builds.
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Per-connection pragmas, applied exactly once when the thread-local
+# connection is created. WAL + synchronous=NORMAL turns the fsync-per-
+# commit of the default DELETE/FULL mode into an append to the log;
+# the rest size the page cache and keep temp B-trees off disk.
+_CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MiB page cache
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA busy_timeout=5000",
+)
+
+
+# SQL for the hot paths lives in module-level constants so the string
+# identity is stable across calls and sqlite3's per-connection statement
+# cache (cached_statements) actually hits instead of re-parsing.
+
+_SQL_INSERT_USER = """
+    INSERT INTO users (user_id, name, email, age, sex, height, weight, country, ethnicity, activity_level)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_USER_RETURNING = _SQL_INSERT_USER + " RETURNING *"
+
+_SQL_INSERT_GOAL = """
+    INSERT INTO user_goals
+    (goal_id, user_id, goal_type, target_weight, target_timeline_weeks,
+     daily_calories, protein_g, carbs_g, fats_g)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_RESTRICTION = """
+    INSERT INTO user_restrictions (restriction_id, user_id, type, restriction, severity)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_PREFERENCES = """
+    INSERT INTO user_preferences
+    (preference_id, user_id, diet_type, cuisine_preferences, meals_per_day,
+     cooking_time_max, budget_weekly, meal_complexity)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_MEAL_PLAN = """
+    INSERT INTO meal_plans (plan_id, user_id, week_start_date, created_by_agent)
+    VALUES (?, ?, ?, ?)
+"""
+
+_SQL_INSERT_PLANNED_MEAL_PREFIX = """
+    INSERT INTO planned_meals
+    (meal_id, plan_id, user_id, day_of_week, meal_type, day_idx, meal_idx, recipe_name,
+     calories, protein_g, carbs_g, fats_g, prep_time_min, ingredients)
+    VALUES """
+
+_MEAL_ROW_PLACEHOLDER = "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+
+# 32 rows x 14 columns = 448 bound variables, comfortably under SQLite's
+# default 999-variable limit. A full week (21-28 meals) fits in one statement.
+_MEAL_INSERT_CHUNK = 32
+
+_SQL_INSERT_ACTUAL_MEAL = """
+    INSERT INTO actual_meals
+    (actual_id, user_id, plan_id, planned_meal_id, day_of_week, meal_type,
+     food_description, calories, protein_g, carbs_g, fats_g, is_planned, logged_by_agent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_SQL_INSERT_MODIFICATION = """
+    INSERT INTO meal_modifications
+    (mod_id, user_id, plan_id, day_of_week, modification_type,
+     original_calories, new_calories, reason, adjusted_by_agent)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Pending Claude completions keyed by (user, prompt hash): written right
+# after the API call parses, deleted once the plan is finalized, so a
+# failed finalize can be retried without re-running the inference.
+_SQL_UPSERT_PENDING = """
+    INSERT OR REPLACE INTO pending_completions (user_id, content_hash, meals)
+    VALUES (?, ?, ?)
+"""
+
+_SQL_GET_PENDING = """
+    SELECT meals FROM pending_completions
+    WHERE user_id = ? AND content_hash = ?
+"""
+
+_SQL_DELETE_PENDING = "DELETE FROM pending_completions WHERE user_id = ? AND content_hash = ?"
+
+_SQL_GET_USER = """
+    SELECT user_id, name, email, age, sex, height, weight, country,
+           ethnicity, activity_level, created_at, updated_at
+    FROM users WHERE user_id = ?
+"""
+
+_SQL_GET_ACTIVE_GOALS = """
+    SELECT goal_id, user_id, goal_type, target_weight, target_timeline_weeks,
+           daily_calories, protein_g, carbs_g, fats_g, is_active, created_at
+    FROM user_goals
+    WHERE user_id = ? AND is_active = 1
+"""
+
+# Narrow macro fetch for calculate_daily_macros: 4 ints straight off
+# idx_goals_user_active instead of hydrating the full goal rows.
+_SQL_GET_DAILY_MACROS = """
+    SELECT daily_calories, protein_g, carbs_g, fats_g
+    FROM user_goals
+    WHERE user_id = ? AND is_active = 1
+    LIMIT 1
+"""
+
+_SQL_GET_RESTRICTIONS = """
+    SELECT restriction_id, user_id, type, restriction, severity, created_at
+    FROM user_restrictions WHERE user_id = ?
+"""
+
+_SQL_GET_CRITICAL_RESTRICTIONS = """
+    SELECT restriction FROM user_restrictions
+    WHERE user_id = ? AND severity IN ('critical', 'important')
+"""
+
+# Display variant: the ', '-joined string is built by group_concat in
+# SQL, so callers that only show the list never materialize it in Python.
+_SQL_GET_CRITICAL_SUMMARY = """
+    SELECT group_concat(restriction, ', ') FROM user_restrictions
+    WHERE user_id = ? AND severity IN ('critical', 'important')
+"""
+
+_SQL_GET_PREFERENCES = """
+    SELECT preference_id, user_id, diet_type, cuisine_preferences, meals_per_day,
+           cooking_time_max, budget_weekly, meal_complexity, created_at, updated_at
+    FROM user_preferences WHERE user_id = ?
+"""
+
+# Plan + meals in one cursor instead of two SELECT round-trips. Explicit
+# columns skip the internal day_idx/meal_idx sort keys so the API payload
+# stays what it always was; the duplicated plan columns cost a few cells
+# per row for <=28 rows. With no meals the LEFT JOIN still yields one
+# row of NULL meal columns, so a fresh plan round-trips correctly.
+_SQL_GET_PLAN_WITH_MEALS = """
+    SELECT p.plan_id, p.user_id, p.week_start_date, p.status, p.total_cost,
+           p.created_by_agent, p.created_at,
+           m.meal_id, m.day_of_week, m.meal_type, m.recipe_name,
+           m.calories, m.protein_g, m.carbs_g, m.fats_g, m.prep_time_min,
+           m.ingredients, m.is_completed, m.created_at
+    FROM meal_plans p
+    LEFT JOIN planned_meals m ON m.plan_id = p.plan_id
+    WHERE p.plan_id = ?
+"""
+
+# One-round-trip context read: the four per-user SELECTs get_user_context
+# fans out to, folded into a single row via SQLite's JSON functions.
+# cuisine_preferences rides along as its own column because json_object
+# cannot hold the msgpack BLOB the list is stored as.
+_SQL_GET_USER_BUNDLE = """
+    SELECT
+        (SELECT json_object(
+            'user_id', user_id, 'name', name, 'email', email, 'age', age,
+            'sex', sex, 'height', height, 'weight', weight, 'country', country,
+            'ethnicity', ethnicity, 'activity_level', activity_level,
+            'created_at', created_at, 'updated_at', updated_at)
+         FROM users WHERE user_id = ?1),
+        (SELECT json_group_array(json_object(
+            'goal_id', goal_id, 'user_id', user_id, 'goal_type', goal_type,
+            'target_weight', target_weight, 'target_timeline_weeks', target_timeline_weeks,
+            'daily_calories', daily_calories, 'protein_g', protein_g,
+            'carbs_g', carbs_g, 'fats_g', fats_g, 'is_active', is_active,
+            'created_at', created_at))
+         FROM user_goals WHERE user_id = ?1 AND is_active = 1),
+        (SELECT json_group_array(json_object(
+            'restriction_id', restriction_id, 'user_id', user_id, 'type', type,
+            'restriction', restriction, 'severity', severity, 'created_at', created_at))
+         FROM user_restrictions WHERE user_id = ?1),
+        (SELECT json_object(
+            'preference_id', preference_id, 'user_id', user_id, 'diet_type', diet_type,
+            'meals_per_day', meals_per_day, 'cooking_time_max', cooking_time_max,
+            'budget_weekly', budget_weekly, 'meal_complexity', meal_complexity,
+            'created_at', created_at, 'updated_at', updated_at)
+         FROM user_preferences WHERE user_id = ?1),
+        (SELECT cuisine_preferences FROM user_preferences WHERE user_id = ?1)
+"""
+
+# Only the plan_id is needed here -- get_meal_plan fetches the rest --
+# so the LIMIT 1 scan can be served from idx_plans_user_status alone.
+_SQL_GET_ACTIVE_PLAN = """
+    SELECT plan_id FROM meal_plans
+    WHERE user_id = ? AND status = 'active'
+    ORDER BY created_at DESC
+    LIMIT 1
+"""
+
+# Per-user delete statements in child-first order; built once so the
+# statement cache hits on every clear_user_data call.
+_SQL_CLEAR_USER = tuple(
+    f"DELETE FROM {table} WHERE user_id = ?"
+    for table in (
+        'pending_completions',
+        'daily_macros',
+        'meal_modifications',
+        'actual_meals',
+        'planned_meals',
+        'meal_plans',
+        'user_preferences',
+        'user_restrictions',
+        'user_goals',
+        'users'
+    )
+)
+
+# Full-wipe script: one parse pass and one commit for all the tables.
+# Un-filtered DELETEs hit SQLite's truncate optimization, and the FK
+# pragma is toggled outside the transaction (it is a no-op inside one).
+_SQL_CLEAR_ALL_SCRIPT = """
+    PRAGMA foreign_keys = OFF;
+    BEGIN;
+    DELETE FROM pending_completions;
+    DELETE FROM daily_macros;
+    DELETE FROM meal_modifications;
+    DELETE FROM actual_meals;
+    DELETE FROM planned_meals;
+    DELETE FROM meal_plans;
+    DELETE FROM user_preferences;
+    DELETE FROM user_restrictions;
+    DELETE FROM user_goals;
+    DELETE FROM users;
+    COMMIT;
+    PRAGMA foreign_keys = ON;
+"""
+
 
 class SQLiteDB:
+    # Columns update_user may touch; anything else in the updates dict is
+    # dropped so dict keys never reach the SQL string (injection-safe).
+    _USER_UPDATE_COLS = frozenset({
+        'name', 'email', 'age', 'sex', 'height', 'weight',
+        'country', 'ethnicity', 'activity_level'
+    })
+
+    # UPDATE statements per sorted column set, built once and shared so
+    # repeat updates with the same keys hit the sqlite3 statement cache.
+    _update_user_sql_cache: Dict[tuple, str] = {}
+
     def __init__(self, db_path: str = "./data/nutrigenie.db"):
         """Initialize SQLite database connection."""
         # Ensure data directory exists
         os.makedirs(os.path.dirname(db_path), exist_ok=True)
-        
+
         self.db_path = db_path
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+        self._local = threading.local()
+
+        # Every connection the factory has opened, across all threads,
+        # so close() can tear the whole pool down at shutdown. The
+        # generation counter bumps on close(); threads holding a
+        # connection from an older generation reopen instead of using a
+        # closed handle.
+        self._conns_lock = threading.Lock()
+        self._all_conns: List[sqlite3.Connection] = []
+        self._generation = 0
+
+        # Small LRU caches for the hot per-user reads. Agent workflows
+        # re-fetch the same profile several times per request; after the
+        # first hit these are dict lookups with no SQLite round-trip.
+        # Each mutator pops the matching key so reads never go stale.
+        self._user_cache: OrderedDict = OrderedDict()
+        self._goals_cache: OrderedDict = OrderedDict()
+        self._macros_cache: OrderedDict = OrderedDict()
+        self._restrictions_cache: OrderedDict = OrderedDict()
+        self._critical_cache: OrderedDict = OrderedDict()
+        self._prefs_cache: OrderedDict = OrderedDict()
+
         self.create_tables()
-    
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        """Connection for the current thread, created on first use.
+
+        One connection per thread (instead of one shared connection) lets
+        the Flask worker threads read while the meal-plan write runs.
+        WAL mode keeps those readers from blocking behind the writer.
+        """
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'generation', -1) != self._generation:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=256)
+            conn.row_factory = sqlite3.Row  # Return rows as dictionaries
+            for pragma in _CONNECTION_PRAGMAS:
+                conn.execute(pragma)
+            self._local.conn = conn
+            self._local.generation = self._generation
+            with self._conns_lock:
+                self._all_conns.append(conn)
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Group several writes into a single durable commit.
+
+        With `with db.transaction():` around a multi-step flow (user +
+        goal + restrictions + preferences) the whole batch costs one
+        fsync instead of one per mutator. BEGIN IMMEDIATE takes the
+        write lock up front so the batch can't deadlock mid-way.
+        """
+        conn = self.conn
+        self._local.in_txn = True
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self._local.in_txn = False
+
+    def _commit(self):
+        """Commit now, unless inside an explicit transaction() block."""
+        if not getattr(self._local, 'in_txn', False):
+            self.conn.commit()
+
+    @staticmethod
+    def _cache_get(cache: OrderedDict, key: str):
+        """LRU-aware cache lookup: a hit moves the key to most-recent."""
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    @staticmethod
+    def _cache_put(cache: OrderedDict, key: str, value):
+        """Store a cache entry, evicting the least-recent past the cap."""
+        cache[key] = value
+        if len(cache) > _READ_CACHE_MAX:
+            cache.popitem(last=False)
+
+    def _invalidate_user_caches(self, user_id: str):
+        """Drop every cached read for a user (after cross-table writes)."""
+        self._user_cache.pop(user_id, None)
+        self._goals_cache.pop(user_id, None)
+        self._macros_cache.pop(user_id, None)
+        self._restrictions_cache.pop(user_id, None)
+        self._critical_cache.pop(user_id, None)
+        self._prefs_cache.pop(user_id, None)
+
     def create_tables(self):
         """Create all necessary tables."""
         cursor = self.conn.cursor()
@@ -114,6 +509,8 @@ class SQLiteDB:
                 user_id TEXT NOT NULL,
                 day_of_week TEXT NOT NULL,
                 meal_type TEXT NOT NULL,
+                day_idx INTEGER,
+                meal_idx INTEGER,
                 recipe_name TEXT,
                 calories INTEGER,
                 protein_g REAL,
@@ -188,20 +585,54 @@ class SQLiteDB:
             )
         """)
         
+        # Pending Claude completions (crash-safety for the slow path)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS pending_completions (
+                user_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                meals TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (user_id, content_hash),
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        """)
+
+        # Secondary indexes so the per-user / per-plan lookups are B-tree
+        # seeks instead of full table scans
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_goals_user_active ON user_goals(user_id, is_active)")
+        # Covering index for the restriction reads: get_critical_restrictions
+        # filters on severity and projects restriction, so the whole query
+        # is answered from the index without touching the table.
+        cursor.execute("DROP INDEX IF EXISTS idx_restrictions_user")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_restrictions_user_severity ON user_restrictions(user_id, severity, restriction)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_preferences_user ON user_preferences(user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_plans_user_status ON meal_plans(user_id, status, created_at DESC)")
+        # idx_planned_meals_order's plan_id prefix serves the plain
+        # plan_id lookups too, so the old single-column index was pure
+        # per-insert maintenance overhead; drop it where it exists.
+        cursor.execute("DROP INDEX IF EXISTS idx_planned_meals_plan")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_planned_meals_order ON planned_meals(plan_id, day_idx, meal_idx)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_planned_meals_user ON planned_meals(user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_actual_meals_user_ts ON actual_meals(user_id, timestamp DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_modifications_user ON meal_modifications(user_id)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_macros_user_date ON daily_macros(user_id, date)")
+
         self.conn.commit()
         print("✅ SQLite tables created successfully")
     
     # ============ USER OPERATIONS ============
     
     def create_user(self, user_data: Dict[str, Any]) -> str:
-        """Create a new user."""
-        user_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO users (user_id, name, email, age, sex, height, weight, country, ethnicity, activity_level)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        """Create a new user.
+
+        On SQLite 3.35+ the insert uses RETURNING * to pull the full row
+        (including DB-side created_at defaults) in the same round-trip
+        and prime the user cache, so the get_user that follows onboarding
+        never touches SQLite.
+        """
+        user_id = _new_id()
+
+        params = (
             user_id,
             user_data.get('name'),
             user_data.get('email'),
@@ -212,42 +643,58 @@ class SQLiteDB:
             user_data.get('country'),
             user_data.get('ethnicity'),
             user_data.get('activity_level')
-        ))
-        
-        self.conn.commit()
+        )
+
+        if _HAS_RETURNING:
+            row = self.conn.execute(_SQL_INSERT_USER_RETURNING, params).fetchone()
+            self._cache_put(self._user_cache, user_id, dict(row))
+        else:
+            self.conn.execute(_SQL_INSERT_USER, params)
+
+        self._commit()
         return user_id
     
     def get_user(self, user_id: str) -> Optional[Dict]:
-        """Get user by ID."""
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    
+        """Get user by ID (cached until the next write for this user)."""
+        user = self._cache_get(self._user_cache, user_id)
+        if user is None:
+            row = self.conn.execute(_SQL_GET_USER, (user_id,)).fetchone()
+            if not row:
+                return None
+            user = dict(row)
+            self._cache_put(self._user_cache, user_id, user)
+        return user
+
     def update_user(self, user_id: str, updates: Dict[str, Any]):
-        """Update user information."""
-        cursor = self.conn.cursor()
-        updates['updated_at'] = datetime.now()
-        
-        set_clause = ", ".join([f"{key} = ?" for key in updates.keys()])
-        values = list(updates.values()) + [user_id]
-        
-        cursor.execute(f"UPDATE users SET {set_clause} WHERE user_id = ?", values)
-        self.conn.commit()
+        """Update user information (whitelisted columns only)."""
+        allowed = {key: value for key, value in updates.items() if key in self._USER_UPDATE_COLS}
+        if not allowed:
+            return
+
+        self._user_cache.pop(user_id, None)
+
+        cols = tuple(sorted(allowed))
+        sql = self._update_user_sql_cache.get(cols)
+        if sql is None:
+            sql = self._update_user_sql_cache[cols] = (
+                "UPDATE users SET "
+                + ", ".join(f"{col} = ?" for col in cols)
+                + ", updated_at = CURRENT_TIMESTAMP WHERE user_id = ?"
+            )
+
+        values = [allowed[col] for col in cols] + [user_id]
+        self.conn.execute(sql, values)
+        self._commit()
     
     # ============ GOALS OPERATIONS ============
     
     def create_goal(self, user_id: str, goal_data: Dict[str, Any]) -> str:
         """Create a new goal for user."""
-        goal_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO user_goals 
-            (goal_id, user_id, goal_type, target_weight, target_timeline_weeks, 
-             daily_calories, protein_g, carbs_g, fats_g)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        self._goals_cache.pop(user_id, None)
+        self._macros_cache.pop(user_id, None)
+        goal_id = _new_id()
+
+        self.conn.execute(_SQL_INSERT_GOAL, (
             goal_id, user_id,
             goal_data.get('goal_type'),
             goal_data.get('target_weight'),
@@ -258,57 +705,156 @@ class SQLiteDB:
             goal_data.get('fats_g')
         ))
         
-        self.conn.commit()
+        self._commit()
         return goal_id
     
     def get_active_goals(self, user_id: str) -> List[Dict]:
-        """Get active goals for user."""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT * FROM user_goals 
-            WHERE user_id = ? AND is_active = 1
-        """, (user_id,))
-        return [dict(row) for row in cursor.fetchall()]
-    
+        """Get active goals for user (cached until the next goal write)."""
+        goals = self._cache_get(self._goals_cache, user_id)
+        if goals is None:
+            cursor = self.conn.execute(_SQL_GET_ACTIVE_GOALS, (user_id,))
+            goals = [dict(row) for row in cursor]
+            self._cache_put(self._goals_cache, user_id, goals)
+        return goals
+
+    def get_daily_macros(self, user_id: str) -> Dict[str, int]:
+        """Get the target daily macros stored with the active goal.
+
+        The values are persisted at profile creation, so this is a
+        verbatim 4-column fetch off idx_goals_user_active (cached until
+        the next goal write) — no full goal-row hydration.
+        """
+        macros = self._cache_get(self._macros_cache, user_id)
+        if macros is None:
+            row = self.conn.execute(_SQL_GET_DAILY_MACROS, (user_id,)).fetchone()
+            if not row:
+                return {}
+            macros = {
+                'calories': row[0],
+                'protein_g': row[1],
+                'carbs_g': row[2],
+                'fats_g': row[3]
+            }
+            self._cache_put(self._macros_cache, user_id, macros)
+        return macros
+
+    def get_user_bundle(self, user_id: str) -> Dict[str, Any]:
+        """Get user, active goals, restrictions and preferences in one query.
+
+        Serves entirely from the per-table caches when they are all warm;
+        otherwise runs one JSON-aggregating statement instead of four
+        SELECT round-trips, then primes all four caches from the row.
+        """
+        user = self._cache_get(self._user_cache, user_id)
+        goals = self._cache_get(self._goals_cache, user_id)
+        restrictions = self._cache_get(self._restrictions_cache, user_id)
+        preferences = self._cache_get(self._prefs_cache, user_id)
+
+        if user is None or goals is None or restrictions is None or preferences is None:
+            row = self.conn.execute(_SQL_GET_USER_BUNDLE, (user_id,)).fetchone()
+            user_json, goals_json, restrictions_json, prefs_json, cuisine_blob = row
+
+            user = orjson.loads(user_json) if user_json else None
+            goals = orjson.loads(goals_json) if goals_json else []
+            restrictions = orjson.loads(restrictions_json) if restrictions_json else []
+            preferences = orjson.loads(prefs_json) if prefs_json else None
+            if preferences is not None:
+                preferences['cuisine_preferences'] = _unpack_list(cuisine_blob)
+
+            if user is not None:
+                self._cache_put(self._user_cache, user_id, user)
+            self._cache_put(self._goals_cache, user_id, goals)
+            self._cache_put(self._restrictions_cache, user_id, restrictions)
+            if preferences is not None:
+                self._cache_put(self._prefs_cache, user_id, preferences)
+
+        return {
+            'user': user,
+            'goals': goals,
+            'restrictions': restrictions,
+            'preferences': preferences
+        }
+
     # ============ RESTRICTIONS OPERATIONS ============
     
     def add_restriction(self, user_id: str, restriction_type: str, restriction: str, severity: str = "moderate") -> str:
         """Add a restriction (allergy, medical, religious)."""
-        restriction_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO user_restrictions (restriction_id, user_id, type, restriction, severity)
-            VALUES (?, ?, ?, ?, ?)
-        """, (restriction_id, user_id, restriction_type, restriction, severity))
+        self._restrictions_cache.pop(user_id, None)
+        self._critical_cache.pop(user_id, None)
+        restriction_id = _new_id()
+
+        self.conn.execute(_SQL_INSERT_RESTRICTION, (restriction_id, user_id, restriction_type, restriction, severity))
         
-        self.conn.commit()
+        self._commit()
         return restriction_id
     
+    def add_restrictions_bulk(self, user_id: str, restrictions: List[tuple]) -> List[str]:
+        """Add multiple restrictions (type, restriction, severity) in one
+        executemany + one commit."""
+        if not restrictions:
+            return []
+
+        self._restrictions_cache.pop(user_id, None)
+        self._critical_cache.pop(user_id, None)
+
+        restriction_ids = []
+        rows = []
+        for restriction_type, restriction, severity in restrictions:
+            restriction_id = _new_id()
+            restriction_ids.append(restriction_id)
+            rows.append((restriction_id, user_id, restriction_type, restriction, severity))
+
+        self.conn.executemany(_SQL_INSERT_RESTRICTION, rows)
+
+        self._commit()
+        return restriction_ids
+
     def get_restrictions(self, user_id: str) -> List[Dict]:
-        """Get all restrictions for user."""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT * FROM user_restrictions WHERE user_id = ?
-        """, (user_id,))
-        return [dict(row) for row in cursor.fetchall()]
+        """Get all restrictions for user (cached until the next write)."""
+        restrictions = self._cache_get(self._restrictions_cache, user_id)
+        if restrictions is None:
+            cursor = self.conn.execute(_SQL_GET_RESTRICTIONS, (user_id,))
+            restrictions = [dict(row) for row in cursor]
+            self._cache_put(self._restrictions_cache, user_id, restrictions)
+        return restrictions
+
+    def get_critical_restrictions(self, user_id: str) -> List[str]:
+        """Get critical/important restriction names, filtered in SQL.
+
+        Cached per user until the next restriction write — every agent
+        turn runs this safety check, so repeats are a dict lookup.
+        """
+        names = self._cache_get(self._critical_cache, user_id)
+        if names is None:
+            cursor = self.conn.execute(_SQL_GET_CRITICAL_RESTRICTIONS, (user_id,))
+            names = [row[0] for row in cursor]
+            self._cache_put(self._critical_cache, user_id, names)
+        return names
+
+    def get_critical_restrictions_summary(self, user_id: str) -> str:
+        """Get critical/important restrictions as one ', '-joined string.
+
+        Serves from the cached name list when warm; on a cold read the
+        join happens in SQL via group_concat, so Python never builds the
+        intermediate list just to display it.
+        """
+        names = self._cache_get(self._critical_cache, user_id)
+        if names is not None:
+            return ', '.join(names)
+        row = self.conn.execute(_SQL_GET_CRITICAL_SUMMARY, (user_id,)).fetchone()
+        return row[0] or ''
     
     # ============ PREFERENCES OPERATIONS ============
     
     def create_preferences(self, user_id: str, pref_data: Dict[str, Any]) -> str:
         """Create user preferences."""
-        pref_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
+        self._prefs_cache.pop(user_id, None)
+        pref_id = _new_id()
+
         # Convert lists to JSON strings
-        cuisine_prefs = json.dumps(pref_data.get('cuisine_preferences', []))
-        
-        cursor.execute("""
-            INSERT INTO user_preferences 
-            (preference_id, user_id, diet_type, cuisine_preferences, meals_per_day, 
-             cooking_time_max, budget_weekly, meal_complexity)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        cuisine_prefs = _pack_list(pref_data.get('cuisine_preferences', []))
+
+        self.conn.execute(_SQL_INSERT_PREFERENCES, (
             pref_id, user_id,
             pref_data.get('diet_type'),
             cuisine_prefs,
@@ -318,136 +864,163 @@ class SQLiteDB:
             pref_data.get('meal_complexity', 'moderate')
         ))
         
-        self.conn.commit()
+        self._commit()
         return pref_id
     
     def get_preferences(self, user_id: str) -> Optional[Dict]:
-        """Get user preferences."""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT * FROM user_preferences WHERE user_id = ?
-        """, (user_id,))
-        row = cursor.fetchone()
-        if row:
+        """Get user preferences (cached until the next preferences write)."""
+        pref = self._cache_get(self._prefs_cache, user_id)
+        if pref is None:
+            row = self.conn.execute(_SQL_GET_PREFERENCES, (user_id,)).fetchone()
+            if not row:
+                return None
             pref = dict(row)
             # Parse JSON fields
-            pref['cuisine_preferences'] = json.loads(pref['cuisine_preferences'])
-            return pref
-        return None
+            pref['cuisine_preferences'] = _unpack_list(pref['cuisine_preferences'])
+            self._cache_put(self._prefs_cache, user_id, pref)
+        return pref
     
     # ============ MEAL PLAN OPERATIONS ============
     
     def create_meal_plan(self, user_id: str, week_start_date: str, created_by_agent: str) -> str:
         """Create a new meal plan."""
-        plan_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO meal_plans (plan_id, user_id, week_start_date, created_by_agent)
-            VALUES (?, ?, ?, ?)
-        """, (plan_id, user_id, week_start_date, created_by_agent))
+        plan_id = _new_id()
+
+        self.conn.execute(_SQL_INSERT_MEAL_PLAN, (plan_id, user_id, week_start_date, created_by_agent))
         
-        self.conn.commit()
+        self._commit()
         return plan_id
     
     def add_planned_meal(self, plan_id: str, user_id: str, meal_data: Dict[str, Any]) -> str:
-        """Add a planned meal to a meal plan."""
-        meal_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        ingredients_json = json.dumps(meal_data.get('ingredients', []))
-        
-        cursor.execute("""
-            INSERT INTO planned_meals 
-            (meal_id, plan_id, user_id, day_of_week, meal_type, recipe_name,
-             calories, protein_g, carbs_g, fats_g, prep_time_min, ingredients)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            meal_id, plan_id, user_id,
-            meal_data.get('day_of_week'),
-            meal_data.get('meal_type'),
-            meal_data.get('recipe_name'),
-            meal_data.get('calories'),
-            meal_data.get('protein_g'),
-            meal_data.get('carbs_g'),
-            meal_data.get('fats_g'),
-            meal_data.get('prep_time_min'),
-            ingredients_json
-        ))
-        
-        self.conn.commit()
-        return meal_id
+        """Add a single planned meal (delegates to the batched insert)."""
+        return self.add_planned_meals(plan_id, user_id, [meal_data])[0]
     
+    def add_planned_meals(self, plan_id: str, user_id: str, meals: List[Dict[str, Any]]) -> List[str]:
+        """Add all planned meals for a plan in one commit.
+
+        Uses a multi-row VALUES insert (chunked under the bound-variable
+        limit) so a whole week lands in one statement rather than one
+        VDBE run per meal.
+        """
+        if not meals:
+            return []
+
+        meal_ids = []
+        rows = []
+        for meal_data in meals:
+            meal_id = _new_id()
+            meal_ids.append(meal_id)
+            day_of_week = meal_data.get('day_of_week')
+            meal_type = meal_data.get('meal_type')
+            day_of_week = _INTERNED_NAMES.get(day_of_week, day_of_week)
+            meal_type = _INTERNED_NAMES.get(meal_type, meal_type)
+            rows.append((
+                meal_id, plan_id, user_id,
+                day_of_week,
+                meal_type,
+                _DAY_IDX.get(day_of_week),
+                _MEAL_IDX.get(meal_type),
+                meal_data.get('recipe_name'),
+                meal_data.get('calories'),
+                meal_data.get('protein_g'),
+                meal_data.get('carbs_g'),
+                meal_data.get('fats_g'),
+                meal_data.get('prep_time_min'),
+                _pack_list(meal_data.get('ingredients', []))
+            ))
+
+        for start in range(0, len(rows), _MEAL_INSERT_CHUNK):
+            chunk = rows[start:start + _MEAL_INSERT_CHUNK]
+            sql = _SQL_INSERT_PLANNED_MEAL_PREFIX + ", ".join([_MEAL_ROW_PLACEHOLDER] * len(chunk))
+            self.conn.execute(sql, tuple(chain.from_iterable(chunk)))
+
+        self._commit()
+        return meal_ids
+
     def get_meal_plan(self, plan_id: str) -> Optional[Dict]:
-        """Get meal plan with all meals."""
-        cursor = self.conn.cursor()
-        
-        # Get plan metadata
-        cursor.execute("SELECT * FROM meal_plans WHERE plan_id = ?", (plan_id,))
-        plan = cursor.fetchone()
-        if not plan:
+        """Get meal plan with all meals (one JOIN, one round-trip)."""
+        rows = self.conn.execute(_SQL_GET_PLAN_WITH_MEALS, (plan_id,)).fetchall()
+        if not rows:
             return None
-        
-        # Get all meals for this plan
-        cursor.execute("""
-            SELECT * FROM planned_meals 
-            WHERE plan_id = ? 
-            ORDER BY 
-                CASE day_of_week
-                    WHEN 'monday' THEN 1
-                    WHEN 'tuesday' THEN 2
-                    WHEN 'wednesday' THEN 3
-                    WHEN 'thursday' THEN 4
-                    WHEN 'friday' THEN 5
-                    WHEN 'saturday' THEN 6
-                    WHEN 'sunday' THEN 7
-                END,
-                CASE meal_type
-                    WHEN 'breakfast' THEN 1
-                    WHEN 'lunch' THEN 2
-                    WHEN 'dinner' THEN 3
-                    WHEN 'snack' THEN 4
-                END
-        """, (plan_id,))
-        
-        meals = [dict(row) for row in cursor.fetchall()]
-        
-        # Parse ingredients JSON
-        for meal in meals:
-            meal['ingredients'] = json.loads(meal['ingredients'])
-        
-        result = dict(plan)
+
+        first = rows[0]
+        result = {
+            'plan_id': first[0],
+            'user_id': first[1],
+            'week_start_date': first[2],
+            'status': first[3],
+            'total_cost': first[4],
+            'created_by_agent': first[5],
+            'created_at': first[6]
+        }
+
+        # first[7] is NULL only when the plan has no meals yet
+        meals = [] if first[7] is None else [
+            {
+                'meal_id': row[7],
+                'plan_id': row[0],
+                'user_id': row[1],
+                'day_of_week': row[8],
+                'meal_type': row[9],
+                'recipe_name': row[10],
+                'calories': row[11],
+                'protein_g': row[12],
+                'carbs_g': row[13],
+                'fats_g': row[14],
+                'prep_time_min': row[15],
+                'ingredients': _unpack_list(row[16]),
+                'is_completed': row[17],
+                'created_at': row[18]
+            }
+            for row in rows
+        ]
+
+        # Order in Python: Timsort on <=28 rows is microseconds, the SQL
+        # stays a bare index lookup, and keying on the names (not the idx
+        # columns) sorts correctly even for rows without idx values.
+        meals.sort(key=lambda meal: (
+            _DAY_IDX.get(meal['day_of_week'], 7),
+            _MEAL_IDX.get(meal['meal_type'], 4)
+        ))
+
         result['meals'] = meals
         return result
     
     def get_user_active_plan(self, user_id: str) -> Optional[Dict]:
         """Get user's active meal plan."""
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            SELECT * FROM meal_plans 
-            WHERE user_id = ? AND status = 'active'
-            ORDER BY created_at DESC
-            LIMIT 1
-        """, (user_id,))
-        
-        plan = cursor.fetchone()
-        if plan:
-            return self.get_meal_plan(dict(plan)['plan_id'])
+        row = self.conn.execute(_SQL_GET_ACTIVE_PLAN, (user_id,)).fetchone()
+        if row:
+            return self.get_meal_plan(row[0])
         return None
     
+    # ============ PENDING COMPLETIONS ============
+
+    def save_pending_completion(self, user_id: str, content_hash: str, meals: List[Dict[str, Any]]):
+        """Persist a parsed Claude completion before plan finalization.
+
+        If create_meal_plan fails afterwards, a resubmit finds this row
+        and skips the multi-second inference entirely.
+        """
+        self.conn.execute(_SQL_UPSERT_PENDING, (user_id, content_hash, _pack_list(meals)))
+        self._commit()
+
+    def get_pending_completion(self, user_id: str, content_hash: str) -> Optional[List[Dict[str, Any]]]:
+        """Get a saved completion for this user + prompt hash, if any."""
+        row = self.conn.execute(_SQL_GET_PENDING, (user_id, content_hash)).fetchone()
+        return _unpack_list(row[0]) if row else None
+
+    def delete_pending_completion(self, user_id: str, content_hash: str):
+        """Drop a pending completion once its plan has been finalized."""
+        self.conn.execute(_SQL_DELETE_PENDING, (user_id, content_hash))
+        self._commit()
+
     # ============ ACTUAL MEALS & MODIFICATIONS ============
     
     def log_actual_meal(self, user_id: str, meal_data: Dict[str, Any]) -> str:
         """Log what user actually ate."""
-        actual_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO actual_meals 
-            (actual_id, user_id, plan_id, planned_meal_id, day_of_week, meal_type,
-             food_description, calories, protein_g, carbs_g, fats_g, is_planned, logged_by_agent)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        actual_id = _new_id()
+
+        self.conn.execute(_SQL_INSERT_ACTUAL_MEAL, (
             actual_id,
             user_id,
             meal_data.get('plan_id'),
@@ -463,20 +1036,14 @@ class SQLiteDB:
             meal_data.get('logged_by_agent')
         ))
         
-        self.conn.commit()
+        self._commit()
         return actual_id
     
     def log_modification(self, user_id: str, plan_id: str, mod_data: Dict[str, Any]) -> str:
         """Log a meal plan modification."""
-        mod_id = str(uuid.uuid4())
-        cursor = self.conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO meal_modifications 
-            (mod_id, user_id, plan_id, day_of_week, modification_type,
-             original_calories, new_calories, reason, adjusted_by_agent)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
+        mod_id = _new_id()
+
+        self.conn.execute(_SQL_INSERT_MODIFICATION, (
             mod_id, user_id, plan_id,
             mod_data.get('day_of_week'),
             mod_data.get('modification_type'),
@@ -486,71 +1053,67 @@ class SQLiteDB:
             mod_data.get('adjusted_by_agent')
         ))
         
-        self.conn.commit()
+        self._commit()
         return mod_id
     
     def clear_all_data(self):
-        """Clear all data from all tables (useful for testing)."""
-        cursor = self.conn.cursor()
+        """Clear all data from all tables (useful for testing).
 
-        # Disable foreign key constraints temporarily
-        cursor.execute("PRAGMA foreign_keys = OFF")
-
-        # Delete data from all tables in correct order (children first)
-        tables = [
-            'daily_macros',
-            'meal_modifications',
-            'actual_meals',
-            'planned_meals',
-            'meal_plans',
-            'user_preferences',
-            'user_restrictions',
-            'user_goals',
-            'users'
-        ]
+        Runs the whole wipe as one executescript: single parse pass,
+        single transaction, children deleted before parents.
+        """
+        self._user_cache.clear()
+        self._goals_cache.clear()
+        self._macros_cache.clear()
+        self._restrictions_cache.clear()
+        self._critical_cache.clear()
+        self._prefs_cache.clear()
 
-        for table in tables:
-            cursor.execute(f"DELETE FROM {table}")
-
-        # Re-enable foreign key constraints
-        cursor.execute("PRAGMA foreign_keys = ON")
-
-        self.conn.commit()
+        self.conn.executescript(_SQL_CLEAR_ALL_SCRIPT)
         print("✅ All database data cleared")
 
     def clear_user_data(self, user_id: str):
-        """Clear all data for a specific user."""
-        cursor = self.conn.cursor()
+        """Clear all data for a specific user.
 
-        # Delete in correct order (children first)
-        cursor.execute("DELETE FROM daily_macros WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM meal_modifications WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM actual_meals WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM planned_meals WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM meal_plans WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM user_preferences WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM user_restrictions WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM user_goals WHERE user_id = ?", (user_id,))
-        cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
+        Runs the child-first deletes from the precompiled statement
+        tuple inside one transaction: one fsync for the whole wipe.
+        """
+        self._invalidate_user_caches(user_id)
+        params = (user_id,)
 
-        self.conn.commit()
+        for sql in _SQL_CLEAR_USER:
+            self.conn.execute(sql, params)
+
+        self._commit()
         print(f"✅ Cleared all data for user: {user_id}")
 
     def delete_user_by_email(self, email: str):
         """Delete user by email (useful for test cleanup)."""
-        cursor = self.conn.cursor()
-
         # Find user_id by email
-        cursor.execute("SELECT user_id FROM users WHERE email = ?", (email,))
-        row = cursor.fetchone()
+        row = self.conn.execute("SELECT user_id FROM users WHERE email = ?", (email,)).fetchone()
 
         if row:
-            user_id = dict(row)['user_id']
+            user_id = row[0]
             self.clear_user_data(user_id)
             print(f"✅ Deleted user with email: {email}")
         else:
             print(f"ℹ️  No user found with email: {email}")
 
     def close(self):
-        """Close database connection."""
-        self.conn.close()
+        """Close every connection the factory has opened, in any thread.
+
+        Bumps the generation so any thread still holding a closed handle
+        reconnects lazily on its next query instead of erroring.
+        """
+        with self._conns_lock:
+            conns, self._all_conns = self._all_conns, []
+            self._generation += 1
+        for conn in conns:
+            try:
+                # Let SQLite refresh its query-planner statistics before
+                # shutdown so the next process starts with good plans.
+                conn.execute("PRAGMA optimize")
+            except sqlite3.Error:
+                pass
+            conn.close()
+        self._local.conn = None
@@ -7,18 +7,87 @@ from uagents import Agent, Context, Model
 from db.memory import get_memory
 from typing import Dict, List, Any, Optional
 import anthropic
+import asyncio
+import hashlib
+import httpx
 import os
+import random
+import re
+from collections import OrderedDict
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
-import json
+from datetime import date
+from functools import lru_cache
+from types import MappingProxyType
+import orjson
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None  # pure-Python macro math is fine for single requests
 
 load_dotenv()
 
-# Initialize memory
-memory = get_memory()
+# Memory is fetched lazily via get_memory() in the message handler so
+# importing this module for calculate_macros etc. stays cheap.
+
+# Initialize Claude API once with a pooled HTTP client.
+# Reusing one AsyncClient keeps TLS connections to api.anthropic.com warm
+# across meal-plan requests instead of paying a handshake per call.
+_http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(
+        max_keepalive_connections=32,
+        max_connections=64,
+        keepalive_expiry=60.0
+    ),
+    timeout=httpx.Timeout(60.0, connect=5.0)
+)
+claude_client = anthropic.AsyncAnthropic(
+    api_key=os.getenv('ANTHROPIC_API_KEY'),
+    http_client=_http_client
+)
+
+# Bound concurrent Claude calls so a burst of requests queues here
+# instead of tripping the API rate limit.
+_claude_semaphore = asyncio.Semaphore(5)
 
-# Initialize Claude API
-claude_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
+# Transient API errors worth retrying (rate limit, server-side, overload)
+_RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 529})
+_CLAUDE_MAX_RETRIES = 4
+
+# Fast tier by default; the accurate tier serves premium users and is
+# the one-time fallback when the fast model is overloaded (HTTP 529).
+_CLAUDE_MODEL = os.getenv('NUTRIGENIE_CLAUDE_MODEL', 'claude-3-5-haiku-20241022')
+_CLAUDE_ACCURATE_MODEL = os.getenv('NUTRIGENIE_CLAUDE_MODEL_ACCURATE', 'claude-3-5-sonnet-latest')
+
+# Content-hash cache for generated plans: two users with the same macros,
+# restrictions and preferences get the same prompt, so the multi-second
+# Claude round-trip can be skipped entirely on a repeat.
+_MEAL_PLAN_CACHE_MAX = 256
+_meal_plan_cache: OrderedDict = OrderedDict()
+_meal_plan_cache_lock = asyncio.Lock()
+
+
+def _meal_plan_cache_key(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int],
+    model: str = None
+) -> str:
+    """Hash everything that reaches the prompt (not user identity) into a cache key.
+
+    The dynamic prompt is the rendered profile fragment plus the daily
+    targets, so hashing exactly those (and the model) guarantees two
+    requests share a key only when they would send Claude the same
+    prompt — no field of _profile_prompt_fragment can drift out of sync
+    with the key.
+    """
+    payload = orjson.dumps({
+        'model': model or _CLAUDE_MODEL,
+        'macros': macros,
+        'profile': _profile_prompt_fragment(user_context)
+    }, option=orjson.OPT_SORT_KEYS)
+
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
 
 # Define message models
 class UserProfileRequest(Model):
@@ -46,58 +115,90 @@ nutrition_agent = Agent(
 @nutrition_agent.on_event("startup")
 async def startup(ctx: Context):
     """Agent startup event."""
+    global _batch_queue
+    _batch_queue = asyncio.Queue()
+    asyncio.create_task(_claude_batch_worker())
     ctx.logger.info(f"🤖 Nutrition Planner Agent started!")
     ctx.logger.info(f"Agent address: {nutrition_agent.address}")
 
 
+@nutrition_agent.on_event("shutdown")
+async def shutdown(ctx: Context):
+    """Close the pooled HTTP client cleanly on agent shutdown."""
+    await _http_client.aclose()
+
+
 def calculate_macros(user_data: Dict[str, Any], goals: Dict[str, Any]) -> Dict[str, int]:
     """
     Calculate daily macros based on user data and goals.
     Uses Mifflin-St Jeor equation for BMR and activity multipliers for TDEE.
     """
+    return dict(_calculate_macros_cached(
+        user_data['weight'],
+        user_data['height'],
+        user_data['age'],
+        user_data['sex'],
+        user_data.get('activity_level', 'moderately_active'),
+        goals.get('goal_type', 'maintain')
+    ))
+
+
+# String → code mappings kept outside the numeric core so it stays
+# Numba-compilable (plain floats/ints only). Read-only proxies built once
+# at import instead of per call.
+_ACTIVITY_MULTIPLIERS = MappingProxyType({
+    'sedentary': 1.2,
+    'lightly_active': 1.375,
+    'moderately_active': 1.55,
+    'very_active': 1.725,
+    'extremely_active': 1.9
+})
+
+_GOAL_CODES = MappingProxyType({
+    'lose_weight': 0,
+    'gain_muscle': 1,
+    'bulk': 2,
+    'cut': 3,
+    'maintain': 4
+})
+
+
+def _macros_core(
+    weight: float,
+    height: float,
+    age: int,
+    sex_code: int,
+    activity_mult: float,
+    goal_code: int
+) -> tuple:
+    """Scalar macro math on plain numbers (JIT-compiled when numba is installed)."""
     # BMR calculation (Mifflin-St Jeor)
-    weight = user_data['weight']
-    height = user_data['height']
-    age = user_data['age']
-    sex = user_data['sex']
-    
-    if sex == 'male':
-        bmr = (10 * weight) + (6.25 * height) - (5 * age) + 5
+    if sex_code == 0:  # male
+        bmr = (10.0 * weight) + (6.25 * height) - (5.0 * age) + 5.0
     else:
-        bmr = (10 * weight) + (6.25 * height) - (5 * age) - 161
-    
+        bmr = (10.0 * weight) + (6.25 * height) - (5.0 * age) - 161.0
+
     # TDEE calculation (activity multiplier)
-    activity_multipliers = {
-        'sedentary': 1.2,
-        'lightly_active': 1.375,
-        'moderately_active': 1.55,
-        'very_active': 1.725,
-        'extremely_active': 1.9
-    }
-    
-    activity_level = user_data.get('activity_level', 'moderately_active')
-    tdee = bmr * activity_multipliers.get(activity_level, 1.55)
-    
+    tdee = bmr * activity_mult
+
     # Adjust for goals
-    goal_type = goals.get('goal_type', 'maintain')
-    
-    if goal_type == 'lose_weight':
-        daily_calories = int(tdee - 500)  # 500 cal deficit
+    if goal_code == 0:  # lose_weight: 500 cal deficit
+        daily_calories = int(tdee - 500.0)
         protein_ratio = 0.40
         carbs_ratio = 0.30
         fats_ratio = 0.30
-    elif goal_type == 'gain_muscle':
-        daily_calories = int(tdee + 300)  # 300 cal surplus
+    elif goal_code == 1:  # gain_muscle: 300 cal surplus
+        daily_calories = int(tdee + 300.0)
         protein_ratio = 0.30
         carbs_ratio = 0.40
         fats_ratio = 0.30
-    elif goal_type == 'bulk':
-        daily_calories = int(tdee + 500)  # 500 cal surplus
+    elif goal_code == 2:  # bulk: 500 cal surplus
+        daily_calories = int(tdee + 500.0)
         protein_ratio = 0.25
         carbs_ratio = 0.45
         fats_ratio = 0.30
-    elif goal_type == 'cut':
-        daily_calories = int(tdee - 300)  # 300 cal deficit
+    elif goal_code == 3:  # cut: 300 cal deficit
+        daily_calories = int(tdee - 300.0)
         protein_ratio = 0.40
         carbs_ratio = 0.30
         fats_ratio = 0.30
@@ -106,123 +207,434 @@ def calculate_macros(user_data: Dict[str, Any], goals: Dict[str, Any]) -> Dict[s
         protein_ratio = 0.30
         carbs_ratio = 0.40
         fats_ratio = 0.30
-    
-    # Calculate macro grams
-    protein_g = int((daily_calories * protein_ratio) / 4)  # 4 cal per gram
-    carbs_g = int((daily_calories * carbs_ratio) / 4)  # 4 cal per gram
-    fats_g = int((daily_calories * fats_ratio) / 9)  # 9 cal per gram
-    
-    return {
-        'daily_calories': daily_calories,
-        'protein_g': protein_g,
-        'carbs_g': carbs_g,
-        'fats_g': fats_g
-    }
 
+    # Calculate macro grams (4 cal/g protein and carbs, 9 cal/g fat)
+    protein_g = int((daily_calories * protein_ratio) / 4.0)
+    carbs_g = int((daily_calories * carbs_ratio) / 4.0)
+    fats_g = int((daily_calories * fats_ratio) / 9.0)
 
-async def generate_meal_plan_with_claude(
-    user_context: Dict[str, Any],
-    macros: Dict[str, int]
-) -> List[Dict[str, Any]]:
+    return daily_calories, protein_g, carbs_g, fats_g
+
+
+if njit is not None:
+    _macros_core = njit(cache=True)(_macros_core)
+
+
+@lru_cache(maxsize=4096)
+def _calculate_macros_cached(
+    weight: float,
+    height: float,
+    age: int,
+    sex: str,
+    activity_level: str,
+    goal_type: str
+) -> tuple:
+    """Memoized macro math — deterministic for a given profile + goal."""
+    daily_calories, protein_g, carbs_g, fats_g = _macros_core(
+        float(weight),
+        float(height),
+        int(age),
+        0 if sex == 'male' else 1,
+        _ACTIVITY_MULTIPLIERS.get(activity_level, 1.55),
+        _GOAL_CODES.get(goal_type, 4)
+    )
+
+    return (
+        ('daily_calories', daily_calories),
+        ('protein_g', protein_g),
+        ('carbs_g', carbs_g),
+        ('fats_g', fats_g)
+    )
+
+
+def calculate_macros_batch(users: List[Dict[str, Any]]) -> List[Dict[str, int]]:
+    """Calculate macros for a whole cohort (batch/warm-up scripts).
+
+    Each user dict carries its own goal_type; the jitted core plus the
+    memo cache keep the per-user cost tiny.
     """
-    Use Claude to generate a personalized 7-day meal plan.
+    return [
+        calculate_macros(user, {'goal_type': user.get('goal_type', 'maintain')})
+        for user in users
+    ]
+
+
+# Static ~90% of the meal-plan prompt: role, schema, rules. Marked with
+# cache_control so Anthropic's prompt caching skips re-prefilling these
+# tokens on every request after the first (5-minute TTL).
+_STATIC_MEAL_PLAN_PROMPT = """You are a professional nutritionist creating a personalized 7-day meal plan.
+
+Create a 7-day meal plan (Monday-Sunday) using the profile, daily targets, restrictions and preferences provided below, with the requested number of meals per day.
+
+Return the plan as JSONL: one meal per line, each line a single JSON object shaped as
+{"day_of_week": str, "meal_type": str, "recipe_name": str, "calories": int, "protein_g": int, "carbs_g": int, "fats_g": int, "prep_time_min": int, "ingredients": [str]}
+with no array brackets, no commas between lines and no other text.
+
+Rules: keep each day's total calories close to the daily target; strictly avoid all listed allergens; respect the diet type and the per-meal prep-time maximum; give 5-7 main ingredients per meal; vary recipes across the week; lowercase day_of_week (monday-sunday) and meal_type (breakfast/lunch/dinner/snack)."""
+
+
+def _profile_prompt_fragment(user_context: Dict[str, Any]) -> str:
+    """Profile/restrictions/preferences section of the prompt.
+
+    Memoized on the context dict itself, so it lives exactly as long as
+    the memory layer's context-cache entry: weekly regenerations reuse
+    it, and any profile write rebuilds the context and with it this
+    fragment.
     """
+    fragment = user_context.get('_prompt_fragment')
+    if fragment is not None:
+        return fragment
+
     user = user_context['user']
     restrictions = user_context['restrictions']
     preferences = user_context['preferences']
-    
-    # Build restrictions list
-    allergies = [r['restriction'] for r in restrictions if r['type'] == 'allergy']
-    medical = [r['restriction'] for r in restrictions if r['type'] == 'medical']
-    
-    # Build prompt
-    prompt = f"""You are a professional nutritionist creating a personalized 7-day meal plan.
-
-USER PROFILE:
+
+    # Build each joined string exactly once
+    allergies_str = ', '.join(
+        r['restriction'] for r in restrictions if r['type'] == 'allergy') or 'None'
+    medical_str = ', '.join(
+        r['restriction'] for r in restrictions if r['type'] == 'medical') or 'None'
+    cuisines_str = ', '.join(preferences.get('cuisine_preferences') or []) or 'Any'
+
+    fragment = f"""USER PROFILE:
 - Age: {user['age']}, Sex: {user['sex']}
 - Current Weight: {user['weight']}kg, Height: {user['height']}cm
 - Country: {user.get('country', 'Not specified')}
 - Ethnicity: {user.get('ethnicity', 'Not specified')}
 - Goal: {user_context['goals'][0]['goal_type'] if user_context['goals'] else 'maintain'}
 
-DAILY TARGETS:
-- Calories: {macros['daily_calories']} kcal
-- Protein: {macros['protein_g']}g
-- Carbs: {macros['carbs_g']}g
-- Fats: {macros['fats_g']}g
-
 RESTRICTIONS (CRITICAL - MUST AVOID):
-- Allergies: {', '.join(allergies) if allergies else 'None'}
-- Medical Conditions: {', '.join(medical) if medical else 'None'}
+- Allergies: {allergies_str}
+- Medical Conditions: {medical_str}
 
 PREFERENCES:
 - Diet Type: {preferences.get('diet_type', 'omnivore')}
-- Cuisines: {', '.join(preferences.get('cuisine_preferences', [])) if preferences.get('cuisine_preferences') else 'Any'}
+- Cuisines: {cuisines_str}
 - Meals Per Day: {preferences.get('meals_per_day', 3)}
 - Max Cooking Time Per Meal: {preferences.get('cooking_time_max', 30)} minutes
-- Budget: ${preferences.get('budget_weekly', 100)}/week
-
-Create a 7-day meal plan (Monday-Sunday) with {preferences.get('meals_per_day', 3)} meals per day.
-
-For each meal, provide:
-1. Recipe name
-2. Estimated calories, protein, carbs, fats
-3. Prep time in minutes
-4. List of main ingredients (5-7 items)
-
-Return ONLY a valid JSON array with this structure:
-[
-  {{
-    "day_of_week": "monday",
-    "meal_type": "breakfast",
-    "recipe_name": "Greek Yogurt Parfait",
-    "calories": 350,
-    "protein_g": 25,
-    "carbs_g": 40,
-    "fats_g": 10,
-    "prep_time_min": 10,
-    "ingredients": ["greek yogurt", "berries", "granola", "honey", "almonds"]
-  }},
-  ...
-]
-
-IMPORTANT:
-- Ensure total daily calories are close to {macros['daily_calories']} kcal
-- Strictly avoid all allergens: {', '.join(allergies) if allergies else 'None'}
-- Respect dietary restrictions: {preferences.get('diet_type', 'omnivore')}
-- Keep prep times under {preferences.get('cooking_time_max', 30)} minutes PER MEAL
-- Provide variety across the week
-- Return ONLY valid JSON, no other text"""
+- Budget: ${preferences.get('budget_weekly', 100)}/week"""
 
-    try:
-        response = claude_client.messages.create(
-            model="claude-3-5-haiku-20241022",  # Claude Haiku 3.5 (available in your account)
-            max_tokens=8000,
+    user_context['_prompt_fragment'] = fragment
+    return fragment
+
+
+def _build_meal_plan_content(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int]
+) -> List[Dict[str, Any]]:
+    """Build the prompt content blocks: cached static rules + dynamic tail."""
+    dynamic = f"""{_profile_prompt_fragment(user_context)}
+
+DAILY TARGETS:
+- Calories: {macros['daily_calories']} kcal
+- Protein: {macros['protein_g']}g
+- Carbs: {macros['carbs_g']}g
+- Fats: {macros['fats_g']}g"""
+
+    return [
+        {
+            "type": "text",
+            "text": _STATIC_MEAL_PLAN_PROMPT,
+            "cache_control": {"type": "ephemeral"}
+        },
+        {"type": "text", "text": dynamic}
+    ]
+
+
+async def stream_meal_plan_with_claude(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int],
+    model: str = None
+):
+    """
+    Stream the meal plan from Claude, yielding each meal dict as soon as
+    its JSON object is complete instead of waiting for the full array.
+
+    A small bracket-depth tracker pulls finished {...} objects out of the
+    token stream, so the first meal is available at first-token latency
+    and any markdown fences around the array are ignored for free.
+
+    API errors propagate raw so the caller can decide what is retryable.
+    """
+    content = _build_meal_plan_content(user_context, macros)
+
+    async with _claude_semaphore:
+        async with claude_client.messages.stream(
+            model=model or _CLAUDE_MODEL,
+            max_tokens=4096,  # 21-28 meals fit in ~3000 tokens
+            temperature=0.0,  # deterministic output, faster sampling
             messages=[{
                 "role": "user",
-                "content": prompt
+                "content": content
             }]
-        )
-        
-        # Extract JSON from response
-        content = response.content[0].text
-        
-        # Try to parse JSON
-        # Remove markdown code blocks if present
-        if "```json" in content:
-            content = content.split("```json")[1].split("```")[0].strip()
-        elif "```" in content:
-            content = content.split("```")[1].split("```")[0].strip()
-        
-        meals = json.loads(content)
-        return meals
-        
-    except Exception as e:
-        error_msg = f"Claude API failed: {str(e)}"
+        ) as stream:
+            obj_chars = []
+            depth = 0
+            in_string = False
+            escape = False
+
+            async for text in stream.text_stream:
+                for ch in text:
+                    if depth:
+                        obj_chars.append(ch)
+                    if in_string:
+                        if escape:
+                            escape = False
+                        elif ch == '\\':
+                            escape = True
+                        elif ch == '"':
+                            in_string = False
+                        continue
+                    if ch == '"':
+                        in_string = True
+                    elif ch == '{':
+                        if depth == 0:
+                            obj_chars = ['{']
+                        depth += 1
+                    elif ch == '}':
+                        depth -= 1
+                        if depth == 0:
+                            yield orjson.loads(''.join(obj_chars))
+                            obj_chars = []
+
+
+async def generate_meal_plan_with_claude(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int],
+    model: str = None
+) -> List[Dict[str, Any]]:
+    """
+    Use Claude to generate a personalized 7-day meal plan.
+    Collects the streamed meals into the familiar list-of-dicts shape,
+    served from the content-hash cache when an identical request was
+    generated recently. Transient API errors (rate limits, overload,
+    connection drops) are retried with capped exponential backoff.
+    """
+    model = model or _CLAUDE_MODEL
+    key = _meal_plan_cache_key(user_context, macros, model)
+
+    async with _meal_plan_cache_lock:
+        cached = _meal_plan_cache.get(key)
+        if cached is not None:
+            _meal_plan_cache.move_to_end(key)
+            # Shallow-copy each meal so callers can't mutate the cache
+            return [dict(meal) for meal in cached]
+
+    meals = []
+    for attempt in range(_CLAUDE_MAX_RETRIES + 1):
+        try:
+            meals = []  # drop any partial meals from a failed attempt
+            async for meal in stream_meal_plan_with_claude(user_context, macros, model):
+                meals.append(meal)
+            break
+        except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+            retryable = (
+                isinstance(e, anthropic.APIConnectionError)
+                or e.status_code in _RETRYABLE_STATUS_CODES
+            )
+            if not retryable or attempt == _CLAUDE_MAX_RETRIES:
+                error_msg = f"Claude API failed: {str(e)}"
+                print(error_msg)
+                raise Exception(error_msg)
+            if getattr(e, 'status_code', None) == 529 and model != _CLAUDE_ACCURATE_MODEL:
+                # Fast model overloaded: retry once on the accurate tier
+                print(f"⚠️ {model} overloaded, falling back to {_CLAUDE_ACCURATE_MODEL}")
+                model = _CLAUDE_ACCURATE_MODEL
+            # Capped exponential backoff with jitter so a burst of
+            # rate-limited requests doesn't retry in lockstep
+            delay = min(30, 2 ** attempt) + random.random()
+            print(f"⚠️ Claude API error ({e}), retry {attempt + 1}/{_CLAUDE_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        except Exception as e:
+            # Non-API failures (e.g. malformed JSON) are not retryable
+            error_msg = f"Claude API failed: {str(e)}"
+            print(error_msg)
+            raise Exception(error_msg)
+
+    if not meals:
+        # Refusal text, prose, or output truncated before the first '}':
+        # the stream parser found nothing. Raise instead of returning (and
+        # caching) an empty plan that would serve every user with this key.
+        error_msg = "Claude API failed: no meals parsed from response"
         print(error_msg)
-        # Raise exception so agent can handle it properly
         raise Exception(error_msg)
 
+    async with _meal_plan_cache_lock:
+        _meal_plan_cache[key] = meals
+        if len(_meal_plan_cache) > _MEAL_PLAN_CACHE_MAX:
+            _meal_plan_cache.popitem(last=False)
+
+    return [dict(meal) for meal in meals]
+
+
+# Pre-vetted baseline plan (omnivore, 3 meals/day, ~2000 kcal) used to
+# short-circuit Claude for restriction-free maintain goals. Loaded lazily
+# so importing the module never touches the filesystem.
+_DEFAULT_PLANS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'default_plans.json')
+_default_plan = None
+
+
+def _load_default_plan() -> Dict[str, Any]:
+    """Load the template plan once; empty dict if the asset is missing."""
+    global _default_plan
+    if _default_plan is None:
+        try:
+            with open(_DEFAULT_PLANS_PATH, 'rb') as f:
+                _default_plan = orjson.loads(f.read())
+        except (OSError, orjson.JSONDecodeError):
+            _default_plan = {}
+    return _default_plan
+
+
+def _template_meal_plan(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int]
+) -> Optional[List[Dict[str, Any]]]:
+    """Deterministic plan for the baseline segment, or None to use Claude.
+
+    Users with a maintain goal, no restrictions and plain omnivore
+    3-meals-a-day preferences get the vetted template scaled to their
+    calorie target — no API call, no queueing, millisecond latency.
+    """
+    goals = user_context['goals']
+    goal_type = goals[0]['goal_type'] if goals else 'maintain'
+    preferences = user_context['preferences'] or {}
+
+    if (goal_type != 'maintain'
+            or user_context['restrictions']
+            or preferences.get('diet_type', 'omnivore') != 'omnivore'
+            or preferences.get('meals_per_day', 3) != 3):
+        return None
+
+    template = _load_default_plan()
+    if not template:
+        return None
+
+    factor = macros['daily_calories'] / template['calories']
+    meals = []
+    for meal in template['meals']:
+        scaled = dict(meal)
+        for field in ('calories', 'protein_g', 'carbs_g', 'fats_g'):
+            scaled[field] = round(meal[field] * factor)
+        meals.append(scaled)
+    return meals
+
+
+# Request batching: profile requests arriving within a short window
+# share one Claude call, amortizing prefill and saving N-1 round trips
+# during onboarding bursts. BATCH_MAX is kept at 2 because Haiku's
+# 8192-token output cap fits roughly two full 7-day plans per response.
+_BATCH_MAX = 2
+_BATCH_WINDOW_MS = 150
+_batch_queue: Optional[asyncio.Queue] = None
+
+# First JSON object in the batch response (fences and commentary ignored)
+_JSON_OBJ_RE = re.compile(r"\{.*\}", re.DOTALL)
+
+
+async def _generate_meal_plan_batched(
+    user_context: Dict[str, Any],
+    macros: Dict[str, int],
+    model: str = None
+) -> List[Dict[str, Any]]:
+    """Generate a plan through the batcher when it is running.
+
+    Falls back to a direct call outside the agent process (tests, API
+    server) where no batch worker has been started, and for non-default
+    models (premium tier) that shouldn't share a batched prompt.
+    """
+    if _batch_queue is None or (model is not None and model != _CLAUDE_MODEL):
+        return await generate_meal_plan_with_claude(user_context, macros, model)
+
+    future = asyncio.get_running_loop().create_future()
+    _batch_queue.put_nowait((user_context, macros, future))
+    return await future
+
+
+async def _claude_batch_worker():
+    """Drain queued generation requests, grouping bursts into one call."""
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + _BATCH_WINDOW_MS / 1000
+        while len(batch) < _BATCH_MAX:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        if len(batch) == 1:
+            # No burst: the single-request path keeps streaming + caching
+            user_context, macros, future = batch[0]
+            try:
+                future.set_result(await generate_meal_plan_with_claude(user_context, macros))
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            await _run_claude_batch(batch)
+
+
+async def _run_claude_batch(batch):
+    """One Claude call for N users, fanned back to each waiter's future."""
+    sections = []
+    for index, (user_context, macros, _) in enumerate(batch, 1):
+        dynamic = _build_meal_plan_content(user_context, macros)[1]["text"]
+        sections.append(f"USER {index}:\n{dynamic}")
+
+    batch_tail = (
+        f"Generate meal plans for {len(batch)} users, each following the "
+        "rules above. Instead of JSONL, return ONLY a JSON object mapping the user number "
+        '(as a string) to that user\'s meal array, e.g. {"1": [...], "2": [...]}.'
+        "\n\n" + "\n\n".join(sections)
+    )
+
+    try:
+        async with _claude_semaphore:
+            response = await claude_client.messages.create(
+                model=_CLAUDE_MODEL,
+                max_tokens=8192,
+                temperature=0.0,
+                messages=[{
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": _STATIC_MEAL_PLAN_PROMPT,
+                            "cache_control": {"type": "ephemeral"}
+                        },
+                        {"type": "text", "text": batch_tail}
+                    ]
+                }]
+            )
+        match = _JSON_OBJ_RE.search(response.content[0].text)
+        plans = orjson.loads(match.group(0) if match else response.content[0].text)
+    except Exception as e:
+        error = Exception(f"Claude API failed: {str(e)}")
+        for _, _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+        return
+
+    for index, (user_context, macros, future) in enumerate(batch, 1):
+        meals = plans.get(str(index))
+        if not isinstance(meals, list) or not meals:
+            # Missing, empty or degenerate per-user plan: fail this
+            # waiter instead of handing back (and caching) an empty plan,
+            # mirroring the zero-meals guard on the single-request path
+            future.set_exception(Exception(f"Claude API failed: no plan for batched user {index}"))
+            continue
+        future.set_result([dict(meal) for meal in meals])
+        # Prime the content-hash cache so identical repeats skip Claude;
+        # the waiter got copies above, so it can't mutate this entry
+        key = _meal_plan_cache_key(user_context, macros)
+        async with _meal_plan_cache_lock:
+            _meal_plan_cache[key] = meals
+            if len(_meal_plan_cache) > _MEAL_PLAN_CACHE_MAX:
+                _meal_plan_cache.popitem(last=False)
+
 
 @nutrition_agent.on_message(model=UserProfileRequest)
 async def handle_user_profile(ctx: Context, sender: str, msg: UserProfileRequest):
@@ -231,10 +643,15 @@ async def handle_user_profile(ctx: Context, sender: str, msg: UserProfileRequest
     This is the main workflow for the Nutrition Planner Agent.
     """
     ctx.logger.info(f"📥 Received user profile request from {sender}")
-    
+    ctx.storage.set(
+        'requests_since_last_log',
+        (ctx.storage.get('requests_since_last_log') or 0) + 1
+    )
+
     try:
         user_data = msg.user_data
-        
+        memory = get_memory()
+
         # Step 1: Calculate macros
         ctx.logger.info("🧮 Calculating macros...")
         macros = calculate_macros(user_data, {
@@ -246,28 +663,51 @@ async def handle_user_profile(ctx: Context, sender: str, msg: UserProfileRequest
         
         # Step 2: Create user profile in memory
         ctx.logger.info("💾 Creating user profile in memory...")
-        user_id = memory.create_user_profile(user_data)
-        
-        # Step 3: Get user context from memory
+        user_id = await asyncio.to_thread(memory.create_user_profile, user_data)
+
+        # Step 3: Kick off the context load in a worker thread so it
+        # overlaps with anything else on the loop, awaited just in time
         ctx.logger.info("🔍 Loading user context...")
-        user_context = memory.get_user_context(user_id)
-        
-        # Step 4: Generate meal plan with Claude
+        ctx_task = asyncio.create_task(asyncio.to_thread(memory.get_user_context, user_id))
+
+        # Step 4: Generate meal plan with Claude, unless a completion from
+        # a previous attempt (Claude succeeded, finalize failed) is pending
         ctx.logger.info("🍽️ Generating meal plan with Claude AI...")
-        meals = await generate_meal_plan_with_claude(user_context, macros)
+        user_context = await ctx_task
+        model = _CLAUDE_ACCURATE_MODEL if user_data.get('tier') == 'premium' else None
+        hash_key = _meal_plan_cache_key(user_context, macros, model)
+        meals = _template_meal_plan(user_context, macros)
+        if meals is not None:
+            ctx.logger.info("⚡ Baseline profile — serving scaled template plan without Claude")
+        else:
+            meals = await asyncio.to_thread(memory.get_pending_completion, user_id, hash_key)
+            if meals is not None:
+                ctx.logger.info("♻️ Reusing pending completion from a previous attempt")
+            else:
+                meals = await _generate_meal_plan_batched(user_context, macros, model)
+                # Persist before finalizing so a transient DB failure below
+                # doesn't throw away the multi-second inference
+                await asyncio.to_thread(memory.save_pending_completion, user_id, hash_key, meals)
         
         # Step 5: Save meal plan to memory
         ctx.logger.info("💾 Saving meal plan to memory...")
-        week_start = datetime.now().strftime('%Y-%m-%d')
-        plan_id = memory.create_meal_plan(
+        week_start = date.today().isoformat()
+        plan_id = await asyncio.to_thread(
+            memory.create_meal_plan,
             user_id=user_id,
             week_start_date=week_start,
             meals=meals,
             created_by_agent="nutrition_planner"
         )
         
-        # Step 6: Get complete meal plan
-        meal_plan = memory.get_meal_plan(plan_id)
+        # Step 6: Fetch the complete plan, re-warm the user context cache
+        # (invalidated by create_meal_plan) and drop the now-finalized
+        # pending completion, all in parallel
+        meal_plan, _, _ = await asyncio.gather(
+            asyncio.to_thread(memory.get_meal_plan, plan_id),
+            asyncio.to_thread(memory.get_user_context, user_id),
+            asyncio.to_thread(memory.delete_pending_completion, user_id, hash_key)
+        )
         
         ctx.logger.info(f"✅ Meal plan created successfully! Plan ID: {plan_id}")
         
@@ -306,10 +746,13 @@ async def handle_user_profile(ctx: Context, sender: str, msg: UserProfileRequest
         await ctx.send(sender, response)
 
 
-@nutrition_agent.on_interval(period=60.0)
+@nutrition_agent.on_interval(period=300.0)
 async def log_status(ctx: Context):
-    """Periodic status log."""
-    ctx.logger.info("🤖 Nutrition Planner Agent is running...")
+    """Periodic status log, emitted only when there was recent activity."""
+    handled = ctx.storage.get('requests_since_last_log') or 0
+    if handled:
+        ctx.logger.info(f"🤖 Nutrition Planner Agent is running... ({handled} requests handled)")
+        ctx.storage.set('requests_since_last_log', 0)
 
 
 if __name__ == "__main__":
@@ -7,10 +7,16 @@ from uagents import Agent, Context, Model
 from db.memory import get_memory
 from typing import Dict, List, Any, Optional
 import anthropic
+import asyncio
+import heapq
 import os
+import time
+from collections import OrderedDict
+from enum import Enum
 from dotenv import load_dotenv
-import json
-import requests
+import logging
+import orjson
+import httpx
 
 load_dotenv()
 
@@ -24,388 +30,684 @@ claude_client = anthropic.Anthropic(api_key=os.getenv('ANTHROPIC_API_KEY'))
 MCP_SERVER_URL = "https://openfoodfacts-mcp.onrender.com/mcp"
 # MCP_SERVER_URL = "https://nona-euryphagous-laraine.ngrok-free.dev/mcp"
 
-# Global MCP session storage
-mcp_session_id = None
-mcp_session_lock = None
-# Use requests.Session() for persistent connection
-mcp_session = None
+# TTL + LRU cache sizing for MCP results: ingredients repeat across meal
+# plans and barcodes recur across ingredients, so a hit skips the whole
+# HTTP round trip (and, for searches, the sorting/formatting work too).
+_MCP_CACHE_MAX = 2048
+_MCP_CACHE_TTL = 3600.0  # seconds
 
+# Circuit breaker: after this many consecutive failures the client
+# fails fast for the cooldown window instead of letting a 30-ingredient
+# plan wait out a 30s timeout per ingredient on a sick server
+_CIRCUIT_THRESHOLD = 5
+_CIRCUIT_COOLDOWN = 30.0  # seconds
 
-# Define message models
-class IngredientListRequest(Model):
-    """Request to find products for ingredients from a meal plan."""
-    plan_id: str
-    user_id: str
 
+def _cache_fetch(cache: OrderedDict, key: str):
+    """Get a live cache entry (LRU touch), dropping it if expired."""
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    expires_at, value = entry
+    if expires_at <= time.monotonic():
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return value
 
-class ProductSuggestion(Model):
-    """Model for a single product suggestion."""
-    ingredient: str
-    products: List[Dict[str, Any]]
 
+def _cache_store(cache: OrderedDict, key: str, value):
+    """Store a cache entry with TTL, evicting the least-recent past the cap."""
+    cache[key] = (time.monotonic() + _MCP_CACHE_TTL, value)
+    if len(cache) > _MCP_CACHE_MAX:
+        cache.popitem(last=False)
 
-class ProductSuggestionsResponse(Model):
-    """Response containing product suggestions for all ingredients."""
-    plan_id: str
-    user_id: str
-    status: str
-    message: str
-    suggestions: Optional[List[Dict[str, Any]]] = None
 
+# ============ PRODUCT PARSING / FORMATTING HELPERS ============
 
-# Create the Product Finder Agent
-product_finder_agent = Agent(
-    name="product_finder",
-    seed="product_finder_seed_phrase_nutrigenie",
-    port=8002,
-    endpoint=["http://localhost:8002/submit"]
-)
-
+def _extract_tool_products(data: Any, ctx: Context, label: str) -> List[Dict[str, Any]]:
+    """Pull the products list out of a tool result (envelope or bare).
 
-async def initialize_mcp_session(ctx: Context) -> Optional[str]:
-    """
-    Initialize MCP session with the server.
-    Uses requests.Session() for persistent connections.
-    Returns session ID if successful, None otherwise.
+    Handles the MCP content-array shape, bare lists, and dicts with a
+    products/results key — the same shapes the search parse always
+    accepted, shared between the per-call and batched paths.
     """
-    global mcp_session_id, mcp_session
+    result = data.get('result', data) if isinstance(data, dict) else data
+    products = []
 
-    if mcp_session_id and mcp_session:
-        ctx.logger.info(f"♻️  Reusing existing MCP session: {mcp_session_id}")
-        return mcp_session_id
+    if isinstance(result, dict) and 'content' in result:
+        for item in result.get('content', []):
+            if item.get('type') == 'text':
+                text_content = item.get('text', '')
+                try:
+                    parsed_content = orjson.loads(text_content)
+                    if isinstance(parsed_content, dict):
+                        products = parsed_content.get('products', parsed_content.get('results', []))
+                    elif isinstance(parsed_content, list):
+                        products = parsed_content
+                    break
+                except orjson.JSONDecodeError:
+                    ctx.logger.warning(f"Could not parse text as JSON for '{label}': {text_content[:200]}...")
+    elif isinstance(result, list):
+        products = result
+    elif isinstance(result, dict):
+        products = result.get('products', result.get('results', []))
 
-    try:
-        ctx.logger.info("🔌 Initializing MCP session with persistent connection...")
-
-        # Create persistent session
-        if not mcp_session:
-            mcp_session = requests.Session()
-            ctx.logger.info("Created new requests.Session() for persistent connection")
-
-        # Initialize request according to MCP protocol
-        init_request = {
-            "jsonrpc": "2.0",
-            "id": 1,
-            "method": "initialize",
-            "params": {
-                "protocolVersion": "2024-11-05",
-                "capabilities": {
-                    "tools": {},
-                    "prompts": {},
-                    "resources": {}
-                },
-                "clientInfo": {
-                    "name": "NutriGenie-ProductFinder",
-                    "version": "1.0.0"
-                }
-            }
-        }
+    return products
 
-        response = mcp_session.post(
-            MCP_SERVER_URL,
-            json=init_request,
-            headers={
-                "Content-Type": "application/json",
-                "Accept": "application/json, text/event-stream"  # Server requires BOTH!
-            },
-            timeout=30
-        )
 
-        ctx.logger.info(f"MCP Response Status: {response.status_code}")
-        ctx.logger.info(f"MCP Response Headers: {dict(response.headers)}")
-        ctx.logger.info(f"MCP Response Body (full): {response.text}")
-        ctx.logger.info(f"MCP Response Cookies: {dict(response.cookies)}")
-        ctx.logger.info(f"Session Cookies after init: {dict(mcp_session.cookies)}")
-
-        if response.status_code == 200:
-            data = response.json()
-            ctx.logger.info(f"Parsed JSON response: {json.dumps(data, indent=2)[:1000]}")
-
-            # Get session ID from response headers (your server uses Mcp-Session-Id)
-            session_id = (
-                response.headers.get('Mcp-Session-Id') or
-                response.headers.get('mcp-session-id') or
-                response.headers.get('x-session-id') or
-                response.headers.get('X-Session-Id') or
-                response.headers.get('session-id') or
-                response.headers.get('Session-Id') or
-                mcp_session.cookies.get('session_id') or
-                mcp_session.cookies.get('sessionId') or
-                data.get('result', {}).get('meta', {}).get('sessionId') or  # Check meta
-                data.get('result', {}).get('sessionId') or
-                data.get('meta', {}).get('sessionId') or  # Check root meta
-                data.get('sessionId')
-            )
+# Sort by nutri-score (A > B > C > D > E); unknowns rank 0 and sort last
+_NUTRI_RANK = {'a': 5, 'b': 4, 'c': 3, 'd': 2, 'e': 1}
 
-            ctx.logger.info(f"Session ID extracted: {session_id}")
 
-            if session_id:
-                mcp_session_id = session_id
-                ctx.logger.info(f"✅ MCP session initialized: {session_id}")
-                return session_id
-            else:
-                # MCP server may be using cookie-based sessions
-                # The requests.Session() will automatically handle cookies
-                ctx.logger.warning("⚠️  No explicit session ID found")
-                ctx.logger.info("✅ Using persistent HTTP session (cookie-based)")
-                ctx.logger.info(f"Session has {len(mcp_session.cookies)} cookies")
-
-                # Mark as initialized with persistent connection
-                mcp_session_id = "persistent"
-                return mcp_session_id
-        else:
-            ctx.logger.error(f"❌ MCP initialization failed: {response.status_code}")
-            ctx.logger.error(f"Response: {response.text}")
-            return None
+def _normalize(product: Dict[str, Any]) -> Dict[str, Any]:
+    """Canonical view of a search row, extracted in one pass.
 
-    except Exception as e:
-        ctx.logger.error(f"❌ Error initializing MCP session: {str(e)}")
-        import traceback
-        ctx.logger.error(traceback.format_exc())
-        return None
+    The sort key and the format loop each chained 3-deep .get fallbacks
+    per field per product; resolving the aliases once here means every
+    later step is a single dict index. 'raw' keeps the original row for
+    fields we don't canonicalize (nutrition fallback when no detail).
+    """
+    # OpenFoodFacts MCP returns camelCase ('nutriScore', 'imageUrl')
+    score = product.get('nutriScore') or product.get('nutri_score') or product.get('nutrition_grade') or ''
+    return {
+        'name': product.get('name') or product.get('product_name') or 'Unknown',
+        'brand': product.get('brand') or product.get('brands') or 'Unknown',
+        'score': score if isinstance(score, str) else '',
+        'barcode': product.get('barcode', product.get('id')),
+        'image': product.get('imageUrl') or product.get('image_url') or product.get('image') or '',
+        'raw': product
+    }
+
+
+def _nutri_sort_key(normalized: Dict[str, Any]) -> int:
+    """Sort key over a normalized row."""
+    return _NUTRI_RANK.get(normalized['score'][:1].lower(), 0)
+
+
+def _extract_tool_detail(data: Any) -> Optional[Dict[str, Any]]:
+    """Parse the full-product dict out of a getProductByBarcode result."""
+    result = data.get('result', data) if isinstance(data, dict) else None
+    if isinstance(result, dict) and 'content' in result:
+        for item in result['content']:
+            if item.get('type') == 'text':
+                try:
+                    full_product = orjson.loads(item['text'])
+                except (orjson.JSONDecodeError, TypeError):
+                    return None
+                return full_product if isinstance(full_product, dict) else None
+    return None
 
 
-async def list_mcp_tools(ctx: Context) -> List[Dict[str, Any]]:
-    """
-    List available tools from MCP server.
-    Returns list of tool definitions.
-    """
-    global mcp_session_id, mcp_session
+def _format_products(
+    top_products: List[Dict[str, Any]],
+    details: List[Optional[Dict[str, Any]]]
+) -> List[Dict[str, Any]]:
+    """Merge normalized search rows with their full-detail lookups into the response shape."""
+    formatted_products = []
+    for normalized, full_product in zip(top_products, details):
+        barcode = normalized['barcode']
+        score = normalized['score']
 
-    if not mcp_session_id or not mcp_session:
-        ctx.logger.error("Cannot list tools: No MCP session")
-        return []
+        # Use full product data if available, otherwise use search result
+        data_source = full_product if full_product else normalized['raw']
 
-    try:
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json, text/event-stream"
-        }
-        if mcp_session_id not in ["stateless", "persistent"]:
-            headers["Mcp-Session-Id"] = mcp_session_id
-
-        list_request = {
-            "jsonrpc": "2.0",
-            "id": 3,
-            "method": "tools/list",
-            "params": {}
-        }
-
-        response = mcp_session.post(
-            MCP_SERVER_URL,
-            json=list_request,
-            headers=headers,
-            timeout=30
-        )
+        # Your MCP server returns 'nutritionFacts' (not 'nutriments')
+        nutrition = data_source.get('nutritionFacts', data_source.get('nutriments', {}))
 
-        if response.status_code == 200:
-            data = response.json()
-            if 'result' in data and 'tools' in data['result']:
-                tools = data['result']['tools']
-                ctx.logger.info(f"📋 Available tools: {[t['name'] for t in tools]}")
-                return tools
-            else:
-                ctx.logger.warning(f"No tools found in response: {data}")
-                return []
-        else:
-            ctx.logger.error(f"Failed to list tools: {response.status_code}")
-            return []
+        formatted_products.append({
+            'product_name': normalized['name'],
+            'brand': normalized['brand'],
+            'nutri_score': score.upper() if score and score.lower() != 'unknown' else 'N/A',
+            'calories_per_100g': nutrition.get('energy', nutrition.get('energy-kcal_100g', nutrition.get('energy_100g', 0))),
+            'protein_per_100g': nutrition.get('proteins', nutrition.get('proteins_100g', 0)),
+            'carbs_per_100g': nutrition.get('carbohydrates', nutrition.get('carbohydrates_100g', 0)),
+            'fats_per_100g': nutrition.get('fat', nutrition.get('fat_100g', 0)),
+            'product_url': f"https://world.openfoodfacts.org/product/{barcode}" if barcode else '',
+            'image_url': normalized['image']
+        })
+    return formatted_products
 
-    except Exception as e:
-        ctx.logger.error(f"Error listing tools: {str(e)}")
-        return []
 
+def _has_inline_nutrition(raw: Dict[str, Any]) -> bool:
+    """True when a search row already embeds its nutrition block."""
+    return bool(raw.get('nutritionFacts') or raw.get('nutriments'))
 
-@product_finder_agent.on_event("startup")
-async def startup(ctx: Context):
-    """Agent startup event."""
-    ctx.logger.info(f"🛒 Product Finder Agent started!")
-    ctx.logger.info(f"Agent address: {product_finder_agent.address}")
-    ctx.logger.info(f"MCP Server: {MCP_SERVER_URL}")
 
-    # Initialize MCP session on startup
-    session_id = await initialize_mcp_session(ctx)
+# ============ MCP CLIENT ============
 
-    if session_id:
-        # List available tools to see what's available
-        await list_mcp_tools(ctx)
+class SessionMode(Enum):
+    """How the MCP server tracks our session."""
+    UNINITIALIZED = 0
+    REAL = 1         # explicit Mcp-Session-Id header on every request
+    PERSISTENT = 2   # cookie/connection-based; no header needed
 
 
-def extract_unique_ingredients(meal_plan: Dict[str, Any]) -> List[str]:
+class MCPClient:
     """
-    Extract unique ingredients from a meal plan.
-    Returns a deduplicated list of ingredient names.
+    One MCP server endpoint: pooled HTTP client, session state, and
+    result caches, all in one object instead of module globals mutated
+    via `global` across async handlers. Per-server state stays coherent
+    under concurrent fan-out, and supporting a second server later is
+    just another instance.
     """
-    ingredients_set = set()
-
-    meals = meal_plan.get('meals', [])
-    for meal in meals:
-        ingredients = meal.get('ingredients', [])
-        for ingredient in ingredients:
-            # Normalize ingredient name (lowercase, strip whitespace)
-            normalized = ingredient.lower().strip()
-            ingredients_set.add(normalized)
-
-    return sorted(list(ingredients_set))
 
+    def __init__(self, url: str):
+        self.url = url
+        # Shared async HTTP client for all calls to this server: the
+        # event loop overlaps concurrent requests, HTTP/2 multiplexes
+        # them over one TLS connection, and keep-alive skips the
+        # handshake per call.
+        # With HTTP/2 one TCP connection multiplexes all streams;
+        # max_connections mostly matters for HTTP/1.1 fallback, where the
+        # default pool of 10 would queue a 30-ingredient burst client-side.
+        # One transport-level retry covers dropped keep-alive connections.
+        self.http = httpx.AsyncClient(
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=1,
+                limits=httpx.Limits(
+                    max_connections=50,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=60.0
+                )
+            ),
+            timeout=30.0,
+            headers={
+                "Content-Type": "application/json",
+                "Accept": "application/json, text/event-stream"  # Server requires BOTH!
+            }
+        )
+        # Session state; the lock makes initialization single-flight
+        # when concurrent ingredient queries all race past an
+        # uninitialized session. Mode and ID are tracked separately so a
+        # cookie-based session isn't a magic string in the ID slot.
+        self.session_mode = SessionMode.UNINITIALIZED
+        self.session_id: Optional[str] = None
+        # Per-request headers, rebuilt only when the session changes:
+        # just the session ID (content-type/accept are client defaults
+        # that httpx merges in), empty for cookie/stateless sessions
+        self._session_headers: Dict[str, str] = {}
+        self.lock = asyncio.Lock()
+        # Whether the server advertises a BatchIt-style batch_execute
+        # tool (detected from tools/list at startup)
+        self.batch_supported = False
+
+        self._search_cache: OrderedDict = OrderedDict()  # ingredient:top_n -> (expires_at, products)
+        self._detail_cache: OrderedDict = OrderedDict()  # barcode -> (expires_at, full_product)
+        self._search_inflight: Dict[str, asyncio.Task] = {}  # single-flight per search key
+        self._sample_logged = False  # field-name probe log fires once per process
+
+        # Circuit breaker state
+        self._failure_count = 0
+        self._circuit_open_until = 0.0
+
+    def _set_session(self, mode: SessionMode, session_id: Optional[str] = None):
+        """Record the session and precompile the per-request headers."""
+        self.session_mode = mode
+        self.session_id = session_id
+        if mode is SessionMode.REAL and session_id:
+            # Your MCP server expects "Mcp-Session-Id" header (case-sensitive)
+            self._session_headers = {"Mcp-Session-Id": session_id}
+        else:
+            self._session_headers = {}
+
+    @property
+    def initialized(self) -> bool:
+        """True once a session (explicit or cookie-based) exists."""
+        return self.session_mode is not SessionMode.UNINITIALIZED
+
+    def _headers(self) -> Dict[str, str]:
+        """Per-request headers, precompiled at session init."""
+        return self._session_headers
+
+    def _circuit_open(self) -> bool:
+        """True while the breaker is tripped and calls should fail fast."""
+        return time.monotonic() < self._circuit_open_until
+
+    def _record_failure(self, ctx: Context):
+        """Count a failed call; trip the breaker past the threshold."""
+        self._failure_count += 1
+        if self._failure_count >= _CIRCUIT_THRESHOLD:
+            self._circuit_open_until = time.monotonic() + _CIRCUIT_COOLDOWN
+            self._failure_count = 0
+            ctx.logger.warning(
+                f"⛔ MCP circuit open for {_CIRCUIT_COOLDOWN:.0f}s after {_CIRCUIT_THRESHOLD} consecutive failures"
+            )
 
-async def query_mcp_for_products(
-    ctx: Context,
-    ingredient: str,
-    top_n: int = 3
-) -> List[Dict[str, Any]]:
-    """
-    Query MCP server for products matching an ingredient.
-    Uses MCP protocol to search OpenFoodFacts database.
+    def _record_success(self):
+        """A successful call closes the failure streak."""
+        self._failure_count = 0
+
+    async def initialize_session(self, ctx: Context) -> bool:
+        """
+        Initialize the MCP session (single-flight).
+        Concurrent callers racing past an uninitialized session
+        serialize on the lock, so exactly one init request goes out and
+        the rest reuse its result. Returns True once a session exists.
+        """
+        if self.initialized:
+            ctx.logger.info(f"♻️  Reusing existing MCP session: {self.session_id or self.session_mode.name.lower()}")
+            return True
+
+        async with self.lock:
+            # Double-checked: another coroutine may have finished the
+            # init while we waited on the lock
+            if self.initialized:
+                return True
+            return await self._initialize_session_locked(ctx)
+
+    async def _initialize_session_locked(self, ctx: Context) -> bool:
+        """The actual init round trip; caller holds self.lock."""
+        try:
+            ctx.logger.info("🔌 Initializing MCP session with persistent connection...")
+
+            # Initialize request according to MCP protocol
+            init_request = {
+                "jsonrpc": "2.0",
+                "id": 1,
+                "method": "initialize",
+                "params": {
+                    "protocolVersion": "2024-11-05",
+                    "capabilities": {
+                        "tools": {},
+                        "prompts": {},
+                        "resources": {}
+                    },
+                    "clientInfo": {
+                        "name": "NutriGenie-ProductFinder",
+                        "version": "1.0.0"
+                    }
+                }
+            }
 
-    Args:
-        ctx: Agent context for logging
-        ingredient: Ingredient name to search for
-        top_n: Number of top products to return
+            response = await self.http.post(self.url, json=init_request)
+
+            if ctx.logger.isEnabledFor(logging.DEBUG):
+                ctx.logger.debug("MCP init status=%s headers=%s", response.status_code, dict(response.headers))
+                ctx.logger.debug("MCP init body=%s", response.text[:500])
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if ctx.logger.isEnabledFor(logging.DEBUG):
+                    ctx.logger.debug("Parsed JSON response: %s", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()[:1000])
+
+                # Get session ID from response headers (your server uses Mcp-Session-Id)
+                session_id = (
+                    response.headers.get('Mcp-Session-Id') or
+                    response.headers.get('mcp-session-id') or
+                    response.headers.get('x-session-id') or
+                    response.headers.get('X-Session-Id') or
+                    response.headers.get('session-id') or
+                    response.headers.get('Session-Id') or
+                    self.http.cookies.get('session_id') or
+                    self.http.cookies.get('sessionId') or
+                    data.get('result', {}).get('meta', {}).get('sessionId') or  # Check meta
+                    data.get('result', {}).get('sessionId') or
+                    data.get('meta', {}).get('sessionId') or  # Check root meta
+                    data.get('sessionId')
+                )
+
+                if session_id:
+                    self._set_session(SessionMode.REAL, session_id)
+                    ctx.logger.info(f"✅ MCP session initialized: {session_id}")
+                    return True
+                else:
+                    # MCP server may be using cookie-based sessions
+                    # The shared client will automatically handle cookies
+                    ctx.logger.warning("⚠️  No explicit session ID found")
+                    ctx.logger.info("✅ Using persistent HTTP session (cookie-based)")
+
+                    # Mark as initialized with persistent connection
+                    self._set_session(SessionMode.PERSISTENT)
+                    return True
+            else:
+                ctx.logger.error(f"❌ MCP initialization failed: {response.status_code}")
+                ctx.logger.error(f"Response: {response.text}")
+                return False
+
+        except Exception as e:
+            ctx.logger.error(f"❌ Error initializing MCP session: {str(e)}")
+            import traceback
+            ctx.logger.error(traceback.format_exc())
+            return False
+
+    async def list_tools(self, ctx: Context) -> List[Dict[str, Any]]:
+        """
+        List available tools from the MCP server.
+        Returns list of tool definitions.
+        """
+        if not self.initialized:
+            ctx.logger.error("Cannot list tools: No MCP session")
+            return []
 
-    Returns:
-        List of product dictionaries with details
-    """
-    global mcp_session_id, mcp_session
+        try:
+            list_request = {
+                "jsonrpc": "2.0",
+                "id": 3,
+                "method": "tools/list",
+                "params": {}
+            }
 
-    try:
-        # Ensure we have a session
-        if not mcp_session_id or not mcp_session:
-            ctx.logger.info("No MCP session, initializing...")
-            mcp_session_id = await initialize_mcp_session(ctx)
+            response = await self.http.post(self.url, json=list_request, headers=self._headers())
+
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if 'result' in data and 'tools' in data['result']:
+                    tools = data['result']['tools']
+                    ctx.logger.info(f"📋 Available tools: {[t['name'] for t in tools]}")
+                    return tools
+                else:
+                    ctx.logger.warning(f"No tools found in response: {data}")
+                    return []
+            else:
+                ctx.logger.error(f"Failed to list tools: {response.status_code}")
+                return []
 
-        if not mcp_session_id or not mcp_session:
-            ctx.logger.error("❌ Cannot query MCP: No session")
+        except Exception as e:
+            ctx.logger.error(f"Error listing tools: {str(e)}")
             return []
 
-        # Call the search tool using JSON-RPC format
-        ctx.logger.info(f"🔍 Searching for products matching '{ingredient}'...")
+    async def batch_call(self, ctx: Context, subcalls: List[Dict[str, Any]]) -> Optional[List[Any]]:
+        """Pack several tool calls into one batch_execute round trip.
 
-        # Build headers with session ID (your server expects Mcp-Session-Id)
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "application/json, text/event-stream"  # Server requires BOTH!
-        }
-        if mcp_session_id and mcp_session_id not in ["stateless", "persistent"]:
-            # Your MCP server expects "Mcp-Session-Id" header (case-sensitive)
-            headers["Mcp-Session-Id"] = mcp_session_id
-            ctx.logger.info(f"Sending request with session ID: {mcp_session_id}")
-
-        # Call the search tool with JSON-RPC
-        # Tool name is "searchProducts" (camelCase), not "search_products"
-        search_request = {
-            "jsonrpc": "2.0",
-            "id": 2,
-            "method": "tools/call",
-            "params": {
-                "name": "searchProducts",  # Correct tool name!
-                "arguments": {
-                    "query": ingredient,
-                    "page": 1,
-                    "pageSize": top_n * 3  # Changed to camelCase
+        Returns one result per subcall, or None when the server lacks
+        the tool or the call fails — callers fall back to per-call
+        requests.
+        """
+        if not self.batch_supported or not subcalls:
+            return None
+
+        try:
+            batch_request = {
+                "jsonrpc": "2.0",
+                "id": 4,
+                "method": "tools/call",
+                "params": {
+                    "name": "batch_execute",
+                    "arguments": {
+                        "calls": subcalls,
+                        "maxConcurrent": 10,
+                        "stopOnError": False
+                    }
                 }
             }
-        }
 
-        ctx.logger.debug(f"Sending request: {json.dumps(search_request, indent=2)}")
-        ctx.logger.info(f"Using persistent session with {len(mcp_session.cookies)} cookies")
+            response = await self.http.post(self.url, json=batch_request, headers=self._headers())
+            if response.status_code != 200:
+                ctx.logger.warning(f"batch_execute returned {response.status_code}, falling back")
+                self._record_failure(ctx)
+                return None
+            self._record_success()
 
-        # Use the persistent session for the request
-        response = mcp_session.post(
-            MCP_SERVER_URL,
-            json=search_request,
-            headers=headers,
-            timeout=30
-        )
+            data = orjson.loads(response.content)
+            result = data.get('result')
+            if isinstance(result, dict) and 'content' in result:
+                for item in result['content']:
+                    if item.get('type') == 'text':
+                        try:
+                            parsed = orjson.loads(item['text'])
+                        except orjson.JSONDecodeError:
+                            return None
+                        if isinstance(parsed, dict):
+                            parsed = parsed.get('results', parsed.get('calls'))
+                        if isinstance(parsed, list) and len(parsed) == len(subcalls):
+                            return parsed
+                        return None
+            elif isinstance(result, list) and len(result) == len(subcalls):
+                return result
+            return None
 
-        if response.status_code != 200:
-            ctx.logger.error(f"MCP server error for '{ingredient}': {response.status_code}")
-            ctx.logger.error(f"Response: {response.text}")
-            return []
+        except Exception as e:
+            ctx.logger.warning(f"batch_execute failed ({e}), falling back to per-call requests")
+            self._record_failure(ctx)
+            return None
 
-        data = response.json()
-        ctx.logger.info(f"MCP Response Status: {response.status_code}")
-        ctx.logger.debug(f"MCP Response: {json.dumps(data, indent=2)[:1000]}")
+    async def batched_find_products(
+        self,
+        ctx: Context,
+        ingredients: List[str],
+        top_n: int = 3
+    ) -> Optional[Dict[str, List[Dict[str, Any]]]]:
+        """
+        Resolve many ingredients via batch_execute: one round trip for
+        all the searches, one more for all the uncached detail lookups —
+        instead of (1 search + top_n details) per ingredient.
+        Returns {ingredient: formatted products}, or None so the caller
+        can fall back to the per-call path.
+        """
+        if not self.batch_supported or not ingredients:
+            return None
 
-        products = []
+        if self._circuit_open():
+            return None
 
-        # Extract products from JSON-RPC response
-        # JSON-RPC format: {"jsonrpc": "2.0", "id": 2, "result": {...}}
-        if 'result' in data:
-            result = data['result']
+        if not self.initialized:
+            await self.initialize_session(ctx)
+        if not self.initialized:
+            return None
 
-            # Check if result contains content array (MCP protocol)
-            if isinstance(result, dict) and 'content' in result:
-                content_items = result.get('content', [])
-                for item in content_items:
-                    if item.get('type') == 'text':
-                        text_content = item.get('text', '')
-                        try:
-                            # Try to parse as JSON
-                            parsed_content = json.loads(text_content)
-                            if isinstance(parsed_content, dict):
-                                products = parsed_content.get('products', parsed_content.get('results', []))
-                            elif isinstance(parsed_content, list):
-                                products = parsed_content
-                            break
-                        except json.JSONDecodeError:
-                            ctx.logger.warning(f"Could not parse text as JSON: {text_content[:200]}...")
-
-            # Check if result is directly a list or dict with products
-            elif isinstance(result, list):
-                products = result
-            elif isinstance(result, dict):
-                products = result.get('products', result.get('results', []))
-
-        # Fallback: check for 'error' in JSON-RPC response
-        elif 'error' in data:
-            error = data['error']
-            ctx.logger.error(f"MCP returned error: {error.get('message', error)}")
-            return []
+        # Serve what we can from the search cache; only batch the misses
+        results_map: Dict[str, List[Dict[str, Any]]] = {}
+        to_search = []
+        for ingredient in ingredients:
+            cached = _cache_fetch(self._search_cache, f"{ingredient}:{top_n}")
+            if cached is not None:
+                results_map[ingredient] = [dict(product) for product in cached]
+            else:
+                to_search.append(ingredient)
+
+        if not to_search:
+            return results_map
+
+        search_calls = [
+            {
+                "name": "searchProducts",
+                "arguments": {"query": ingredient, "page": 1, "pageSize": top_n * 3}
+            }
+            for ingredient in to_search
+        ]
+        search_results = await self.batch_call(ctx, search_calls)
+        if search_results is None:
+            return None
 
-        if not products:
-            ctx.logger.warning(f"⚠️  No products found for '{ingredient}'")
+        # Rank each ingredient's products and collect the barcodes we
+        # still need details for (the detail cache dedupes repeats
+        # across ingredients)
+        top_by_ingredient: Dict[str, List[Dict[str, Any]]] = {}
+        barcodes_needed: List[str] = []
+        for ingredient, result in zip(to_search, search_results):
+            products = [_normalize(product) for product in _extract_tool_products(result, ctx, ingredient)]
+            # O(N log top_n) top-N selection instead of a full sort
+            top_products = heapq.nlargest(top_n, products, key=_nutri_sort_key)
+            top_by_ingredient[ingredient] = top_products
+            for product in top_products:
+                # No detail call needed when the search row embeds nutrition
+                if _has_inline_nutrition(product['raw']):
+                    continue
+                barcode = product['barcode']
+                if barcode:
+                    barcode = str(barcode)
+                    if barcode not in barcodes_needed and _cache_fetch(self._detail_cache, barcode) is None:
+                        barcodes_needed.append(barcode)
+
+        if barcodes_needed:
+            detail_calls = [
+                {"name": "getProductByBarcode", "arguments": {"barcode": barcode}}
+                for barcode in barcodes_needed
+            ]
+            detail_results = await self.batch_call(ctx, detail_calls)
+            if detail_results is not None:
+                for barcode, result in zip(barcodes_needed, detail_results):
+                    full_product = _extract_tool_detail(result)
+                    if full_product:
+                        _cache_store(self._detail_cache, barcode, full_product)
+
+        # Format from the (now warm) detail cache and prime the search
+        # cache so later single-ingredient lookups hit it too
+        for ingredient, top_products in top_by_ingredient.items():
+            details = []
+            for product in top_products:
+                raw = product['raw']
+                if _has_inline_nutrition(raw):
+                    details.append(raw)
+                    continue
+                barcode = product['barcode']
+                details.append(_cache_fetch(self._detail_cache, str(barcode)) if barcode else None)
+
+            formatted = _format_products(top_products, details)
+            results_map[ingredient] = formatted
+            if formatted:
+                _cache_store(self._search_cache, f"{ingredient}:{top_n}", formatted)
+
+        return results_map
+
+    async def query_products(
+        self,
+        ctx: Context,
+        ingredient: str,
+        top_n: int = 3
+    ) -> List[Dict[str, Any]]:
+        """
+        Query the MCP server for products matching an ingredient.
+        Served from the TTL cache when the same ingredient was looked up
+        within the last hour; concurrent lookups for the same ingredient
+        share one MCP round trip (single-flight) instead of stampeding.
+
+        Args:
+            ctx: Agent context for logging
+            ingredient: Ingredient name to search for
+            top_n: Number of top products to return
+
+        Returns:
+            List of product dictionaries with details
+        """
+        key = f"{ingredient.lower().strip()}:{top_n}"
+
+        products = _cache_fetch(self._search_cache, key)
+        if products is not None:
+            ctx.logger.info(f"♻️  Cache hit for '{ingredient}'")
+            return [dict(product) for product in products]
+
+        # Fail fast while the breaker is open — cache hits above still serve
+        if self._circuit_open():
             return []
 
-        ctx.logger.info(f"📦 Got {len(products)} products from MCP server")
+        task = self._search_inflight.get(key)
+        if task is not None:
+            products = await task
+            return [dict(product) for product in products]
+
+        task = asyncio.ensure_future(self._query_products_uncached(ctx, ingredient, top_n))
+        self._search_inflight[key] = task
+        try:
+            products = await task
+        finally:
+            self._search_inflight.pop(key, None)
 
-        # Debug: Log first product structure to see field names
         if products:
-            ctx.logger.info(f"Sample product structure: {json.dumps(products[0], indent=2)}")
-
-        # Sort by nutri-score (A > B > C > D > E)
-        nutri_score_rank = {'a': 5, 'b': 4, 'c': 3, 'd': 2, 'e': 1}
-
-        def get_nutri_score_value(product):
-            # OpenFoodFacts MCP returns 'nutriScore' (camelCase)
-            score = product.get('nutriScore', product.get('nutri_score', product.get('nutrition_grade', 'unknown')))
-            if isinstance(score, str):
-                score = score.lower()
-                if score == 'unknown':
-                    return 0  # Put unknowns at the end
-            else:
-                score = 'unknown'
-            return nutri_score_rank.get(score, 0)
+            _cache_store(self._search_cache, key, products)
+        return [dict(product) for product in products]
+
+    async def _query_products_uncached(
+        self,
+        ctx: Context,
+        ingredient: str,
+        top_n: int = 3
+    ) -> List[Dict[str, Any]]:
+        """Search + detail-fetch + format for one ingredient (cache miss path)."""
+        try:
+            # Ensure we have a session
+            if not self.initialized:
+                ctx.logger.info("No MCP session, initializing...")
+                await self.initialize_session(ctx)
+
+            if not self.initialized:
+                ctx.logger.error("❌ Cannot query MCP: No session")
+                return []
 
-        products_sorted = sorted(
-            products,
-            key=get_nutri_score_value,
-            reverse=True
-        )
+            # Call the search tool using JSON-RPC format
+            ctx.logger.info(f"🔍 Searching for products matching '{ingredient}'...")
+
+            headers = self._headers()
+
+            # Call the search tool with JSON-RPC
+            # Tool name is "searchProducts" (camelCase), not "search_products"
+            search_request = {
+                "jsonrpc": "2.0",
+                "id": 2,
+                "method": "tools/call",
+                "params": {
+                    "name": "searchProducts",  # Correct tool name!
+                    "arguments": {
+                        "query": ingredient,
+                        "page": 1,
+                        "pageSize": top_n * 3  # Changed to camelCase
+                    }
+                }
+            }
+
+            if ctx.logger.isEnabledFor(logging.DEBUG):
+                ctx.logger.debug("Sending request: %s", orjson.dumps(search_request, option=orjson.OPT_INDENT_2).decode())
 
-        # Return top N products
-        top_products = products_sorted[:top_n]
+            # Use the shared async client for the request
+            response = await self.http.post(self.url, json=search_request, headers=headers)
+
+            if response.status_code != 200:
+                ctx.logger.error(f"MCP server error for '{ingredient}': {response.status_code}")
+                ctx.logger.error(f"Response: {response.text}")
+                self._record_failure(ctx)
+                return []
+            self._record_success()
+
+            data = orjson.loads(response.content)
+            if ctx.logger.isEnabledFor(logging.DEBUG):
+                ctx.logger.debug("MCP Response: %s", orjson.dumps(data, option=orjson.OPT_INDENT_2).decode()[:1000])
+
+            # Fallback: check for 'error' in JSON-RPC response
+            if 'result' not in data and 'error' in data:
+                error = data['error']
+                ctx.logger.error(f"MCP returned error: {error.get('message', error)}")
+                return []
 
-        # Format the response - get full details for each product
-        formatted_products = []
-        for product in top_products:
-            barcode = product.get('barcode', product.get('id'))
+            products = _extract_tool_products(data, ctx, ingredient)
 
-            # Try to get full product details if barcode available
-            full_product = None
-            if barcode:
+            if not products:
+                ctx.logger.warning(f"⚠️  No products found for '{ingredient}'")
+                return []
+
+            # Debug probe: log the first product structure once per process
+            # to see field names, not a ~2KB pretty-print per search
+            if not self._sample_logged and ctx.logger.isEnabledFor(logging.DEBUG):
+                self._sample_logged = True
+                ctx.logger.debug("Got %d products; sample: %s", len(products),
+                                 orjson.dumps(products[0], option=orjson.OPT_INDENT_2).decode())
+
+            # Top N products by nutri-score: heapq.nlargest is O(N log top_n)
+            # and never materializes the fully sorted list
+            top_products = heapq.nlargest(
+                top_n,
+                (_normalize(product) for product in products),
+                key=_nutri_sort_key
+            )
+
+            # Fetch full details for all top products concurrently — the
+            # getProductByBarcode calls are independent, so the detail
+            # phase costs one round trip instead of one per product.
+            async def fetch_detail(product):
+                # Search rows often already embed the nutrition block —
+                # skip the round trip when there's nothing more to learn
+                raw = product['raw']
+                if _has_inline_nutrition(raw):
+                    return raw
+                barcode = product['barcode']
+                if not barcode:
+                    return None
+                cached = _cache_fetch(self._detail_cache, str(barcode))
+                if cached is not None:
+                    return cached
                 try:
-                    ctx.logger.debug(f"Fetching full details for barcode: {barcode}")
+                    ctx.logger.debug("Fetching full details for barcode: %s", barcode)
                     detail_request = {
                         "jsonrpc": "2.0",
                         "id": f"detail_{barcode}",
@@ -415,60 +717,206 @@ async def query_mcp_for_products(
                             "arguments": {"barcode": str(barcode)}
                         }
                     }
-                    detail_response = mcp_session.post(
-                        MCP_SERVER_URL,
+                    detail_response = await self.http.post(
+                        self.url,
                         json=detail_request,
                         headers=headers,
-                        timeout=10
+                        timeout=10.0
                     )
                     if detail_response.status_code == 200:
-                        detail_data = detail_response.json()
-                        ctx.logger.info(f"Detail response for {barcode}: {json.dumps(detail_data, indent=2)[:800]}")
-                        if 'result' in detail_data and 'content' in detail_data['result']:
-                            for item in detail_data['result']['content']:
-                                if item.get('type') == 'text':
-                                    try:
-                                        full_product = json.loads(item['text'])
-                                        ctx.logger.info(f"Parsed full product keys: {list(full_product.keys())}")
-                                        break
-                                    except Exception as parse_err:
-                                        ctx.logger.warning(f"Could not parse text: {parse_err}")
-                                        pass
+                        full_product = _extract_tool_detail(orjson.loads(detail_response.content))
+                        if full_product:
+                            _cache_store(self._detail_cache, str(barcode), full_product)
+                            return full_product
                 except Exception as e:
                     ctx.logger.warning(f"Could not fetch details for {barcode}: {e}")
+                return None
+
+            details = await asyncio.gather(*(fetch_detail(product) for product in top_products))
+
+            # Format the response using the full details where available
+            formatted_products = _format_products(top_products, details)
+
+            ctx.logger.info(f"✅ Found {len(formatted_products)} products for '{ingredient}'")
+            return formatted_products
+
+        except httpx.TimeoutException:
+            ctx.logger.error(f"⏱️ Timeout querying MCP server for '{ingredient}'")
+            self._record_failure(ctx)
+            return []
+        except httpx.HTTPError as e:
+            ctx.logger.error(f"❌ Network error for '{ingredient}': {str(e)}")
+            self._record_failure(ctx)
+            return []
+        except Exception as e:
+            ctx.logger.error(f"❌ Error querying MCP for '{ingredient}': {str(e)}")
+            return []
+
+    async def prewarm(self, ctx: Context, ingredients: List[str]):
+        """
+        Pre-cache searches for common ingredients during startup, off
+        the user critical path. Failures are harmless — the cache just
+        stays cold for those entries.
+        """
+        await asyncio.gather(
+            *(self.query_products(ctx, ingredient) for ingredient in ingredients),
+            return_exceptions=True
+        )
+
+    async def keep_alive(self):
+        """Best-effort ping so the pooled connection never idles cold."""
+        if self.initialized:
+            try:
+                ping_request = {"jsonrpc": "2.0", "id": 5, "method": "tools/list", "params": {}}
+                await self.http.post(self.url, json=ping_request, headers=self._headers())
+            except Exception:
+                pass  # The next real request will reconnect
+
+    async def aclose(self):
+        """Close the pooled HTTP client."""
+        await self.http.aclose()
+
+
+# Single client for the configured server; a second MCP endpoint would
+# just be another MCPClient instance
+mcp = MCPClient(MCP_SERVER_URL)
+
+# Pantry staples that show up in almost every generated plan — worth
+# pre-caching at startup so the first real request hits warm entries
+_PREWARM_INGREDIENTS = ['chicken', 'rice', 'tomato', 'onion', 'olive oil']
+
+
+# Define message models
+class IngredientListRequest(Model):
+    """Request to find products for ingredients from a meal plan."""
+    plan_id: str
+    user_id: str
+
+
+class ProductSuggestion(Model):
+    """Model for a single product suggestion."""
+    ingredient: str
+    products: List[Dict[str, Any]]
+
+
+class PartialSuggestion(Model):
+    """
+    Streamed suggestion for one ingredient, sent as soon as its lookup
+    completes so the requester can start using results immediately
+    instead of waiting for the whole plan. A terminal
+    ProductSuggestionsResponse still follows with the full set.
+    """
+    plan_id: str
+    user_id: str
+    ingredient: str
+    products: List[Dict[str, Any]]
 
-            # Use full product data if available, otherwise use search result
-            data_source = full_product if full_product else product
-
-            # Your MCP server returns 'nutritionFacts' (not 'nutriments')
-            nutrition = data_source.get('nutritionFacts', data_source.get('nutriments', {}))
-
-            ctx.logger.debug(f"Nutrition data for {barcode}: {nutrition}")
-
-            formatted_products.append({
-                'product_name': product.get('name', product.get('product_name', 'Unknown')),
-                'brand': product.get('brand', product.get('brands', 'Unknown')),
-                'nutri_score': product.get('nutriScore', product.get('nutri_score', product.get('nutrition_grade', 'unknown'))).upper() if product.get('nutriScore') not in [None, 'unknown'] else 'N/A',
-                'calories_per_100g': nutrition.get('energy', nutrition.get('energy-kcal_100g', nutrition.get('energy_100g', 0))),
-                'protein_per_100g': nutrition.get('proteins', nutrition.get('proteins_100g', 0)),
-                'carbs_per_100g': nutrition.get('carbohydrates', nutrition.get('carbohydrates_100g', 0)),
-                'fats_per_100g': nutrition.get('fat', nutrition.get('fat_100g', 0)),
-                'product_url': f"https://world.openfoodfacts.org/product/{barcode}" if barcode else '',
-                'image_url': product.get('imageUrl', product.get('image_url', product.get('image', '')))
-            })
-
-        ctx.logger.info(f"✅ Found {len(formatted_products)} products for '{ingredient}'")
-        return formatted_products
-
-    except requests.exceptions.Timeout:
-        ctx.logger.error(f"⏱️ Timeout querying MCP server for '{ingredient}'")
-        return []
-    except requests.exceptions.RequestException as e:
-        ctx.logger.error(f"❌ Network error for '{ingredient}': {str(e)}")
-        return []
-    except Exception as e:
-        ctx.logger.error(f"❌ Error querying MCP for '{ingredient}': {str(e)}")
-        return []
+
+class ProductSuggestionsResponse(Model):
+    """Response containing product suggestions for all ingredients."""
+    plan_id: str
+    user_id: str
+    status: str
+    message: str
+    suggestions: Optional[List[Dict[str, Any]]] = None
+
+
+# Create the Product Finder Agent
+product_finder_agent = Agent(
+    name="product_finder",
+    seed="product_finder_seed_phrase_nutrigenie",
+    port=8002,
+    endpoint=["http://localhost:8002/submit"]
+)
+
+
+@product_finder_agent.on_event("startup")
+async def startup(ctx: Context):
+    """Agent startup event."""
+    ctx.logger.info(f"🛒 Product Finder Agent started!")
+    ctx.logger.info(f"Agent address: {product_finder_agent.address}")
+    ctx.logger.info(f"MCP Server: {MCP_SERVER_URL}")
+
+    # Initialize MCP session on startup
+    initialized = await mcp.initialize_session(ctx)
+
+    if initialized:
+        # With a session in hand, the tools listing and the pantry-staple
+        # cache prewarm are independent — overlap them instead of paying
+        # each round trip in sequence on cold start
+        tools, _ = await asyncio.gather(
+            mcp.list_tools(ctx),
+            mcp.prewarm(ctx, _PREWARM_INGREDIENTS)
+        )
+
+        # Detect BatchIt-style batching so handlers can pack many tool
+        # calls into one round trip instead of one HTTP request each
+        mcp.batch_supported = any(tool.get('name') == 'batch_execute' for tool in tools)
+        if mcp.batch_supported:
+            ctx.logger.info("📦 MCP server supports batch_execute — batching enabled")
+
+
+@product_finder_agent.on_event("shutdown")
+async def shutdown(ctx: Context):
+    """Close the pooled MCP client cleanly on agent shutdown."""
+    await mcp.aclose()
+
+
+# Modifier words that don't change which product to search for
+_INGREDIENT_STOPWORDS = frozenset({
+    'fresh', 'organic', 'raw', 'cooked', 'chopped', 'diced', 'sliced',
+    'ground', 'frozen', 'dried', 'large', 'small', 'medium'
+})
+
+# Raw ingredient string -> canonical form; meal plans repeat the same
+# strings constantly, so each one is canonicalized at most once
+_canonical_cache: Dict[str, str] = {}
+
+
+def _singular(word: str) -> str:
+    """Naive depluralization, good enough for grocery nouns."""
+    if word.endswith('ies') and len(word) > 4:
+        return word[:-3] + 'y'       # berries -> berry
+    if word.endswith('oes') and len(word) > 4:
+        return word[:-2]             # tomatoes -> tomato
+    if word.endswith('s') and not word.endswith(('ss', 'us')) and len(word) > 3:
+        return word[:-1]             # carrots -> carrot
+    return word
+
+
+def canonicalize_ingredient(raw: str) -> str:
+    """
+    Map ingredient variants to one canonical search term.
+    "fresh tomatoes", "Tomato" and "chopped tomatoes" all collapse to
+    "tomato", so semantically identical ingredients share one MCP
+    search (and one cache entry) instead of each paying a round trip.
+    """
+    cached = _canonical_cache.get(raw)
+    if cached is not None:
+        return cached
+
+    words = [
+        _singular(word)
+        for word in raw.lower().split()
+        if word not in _INGREDIENT_STOPWORDS
+    ]
+    canonical = ' '.join(words) or raw.lower().strip()
+
+    _canonical_cache[raw] = canonical
+    return canonical
+
+
+def extract_unique_ingredients(meal_plan: Dict[str, Any]) -> List[str]:
+    """
+    Extract unique ingredients from a meal plan.
+    Returns a deduplicated list of canonical ingredient names
+    ("fresh tomatoes" and "tomato" collapse to one query).
+    """
+    return sorted({
+        canonicalize_ingredient(ingredient)
+        for meal in meal_plan.get('meals', ())
+        for ingredient in meal.get('ingredients', ())
+    })
 
 
 @product_finder_agent.on_message(model=IngredientListRequest)
@@ -513,14 +961,59 @@ async def handle_ingredient_list(ctx: Context, sender: str, msg: IngredientListR
             await ctx.send(sender, response)
             return
 
-        # Step 3: Query MCP server for each ingredient
+        # Step 3: Query MCP server for all ingredients.
+        # Preferred path: batch_execute packs every search (and then every
+        # detail lookup) into one round trip each. Fallback: concurrent
+        # per-ingredient calls, with a semaphore capping in-flight requests
+        # so a big plan doesn't hammer the MCP server.
         ctx.logger.info("🛒 Querying MCP server for product suggestions...")
-        all_suggestions = []
 
-        for ingredient in unique_ingredients:
-            ctx.logger.info(f"Searching products for: {ingredient}")
-            products = await query_mcp_for_products(ctx, ingredient, top_n=3)
+        results_by_ingredient: Dict[str, List[Dict[str, Any]]] = {}
+
+        batched = None
+        if mcp.batch_supported:
+            batched = await mcp.batched_find_products(ctx, unique_ingredients, top_n=3)
+
+        if batched is not None:
+            # Batch results all land together; still emit the per-
+            # ingredient partials so downstream handling is uniform
+            for ingredient in unique_ingredients:
+                products = batched.get(ingredient, [])
+                results_by_ingredient[ingredient] = products
+                await ctx.send(sender, PartialSuggestion(
+                    plan_id=msg.plan_id,
+                    user_id=msg.user_id,
+                    ingredient=ingredient,
+                    products=products
+                ))
+        else:
+            search_limit = asyncio.Semaphore(10)
+
+            async def find_products(ingredient: str):
+                async with search_limit:
+                    try:
+                        return ingredient, await mcp.query_products(ctx, ingredient, top_n=3)
+                    except Exception as e:
+                        ctx.logger.error(f"❌ Product lookup failed for '{ingredient}': {e}")
+                        return ingredient, []
+
+            # Stream each suggestion the moment its lookup finishes
+            # rather than holding everything for one big payload
+            for task in asyncio.as_completed(
+                [find_products(ingredient) for ingredient in unique_ingredients]
+            ):
+                ingredient, products = await task
+                results_by_ingredient[ingredient] = products
+                await ctx.send(sender, PartialSuggestion(
+                    plan_id=msg.plan_id,
+                    user_id=msg.user_id,
+                    ingredient=ingredient,
+                    products=products
+                ))
 
+        all_suggestions = []
+        for ingredient in unique_ingredients:
+            products = results_by_ingredient.get(ingredient, [])
             suggestion = {
                 'ingredient': ingredient,
                 'products': products,
@@ -558,9 +1051,14 @@ async def handle_ingredient_list(ctx: Context, sender: str, msg: IngredientListR
 
 @product_finder_agent.on_interval(period=60.0)
 async def log_status(ctx: Context):
-    """Periodic status log."""
+    """Periodic status log + MCP connection keep-alive."""
     ctx.logger.info("🛒 Product Finder Agent is running...")
 
+    # Ping the server so the pooled HTTP/2 connection warmed at startup
+    # never idles past its keep-alive expiry — the next user request
+    # then skips the TCP + TLS handshake entirely.
+    await mcp.keep_alive()
+
 
 if __name__ == "__main__":
     print("🚀 Starting Product Finder Agent...")
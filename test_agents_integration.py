@@ -10,7 +10,6 @@ from uagents import Agent, Bureau, Context, Model
 from first_agent import UserProfileRequest, MealPlanResponse, nutrition_agent
 from second_agent import IngredientListRequest, ProductSuggestionsResponse, product_finder_agent
 from db.memory import get_memory
-import json
 
 
 # Create a test orchestrator agent
@@ -0,0 +1,20 @@
+"""
+WSGI entry point for running the API server under a production server.
+
+The Flask dev server handles one request at a time, so a slow Claude call
+would block every other endpoint. Run with one threaded worker instead:
+
+    gunicorn -k gthread -w 1 --threads 16 -b 0.0.0.0:5000 wsgi:app
+
+Keep it at a single worker process: the in-process read caches (SQLite
+row caches, memoized user context, conversation search caches) have no
+cross-process invalidation, and each extra worker would open its own
+Chroma PersistentClient on the same path, which Chroma does not support
+for concurrent writers. Threads share all of those safely; processes
+don't.
+"""
+
+from api_server import app
+
+if __name__ == "__main__":
+    app.run()